@@ -6,7 +6,9 @@ import zope.interface
 import gocept.imapapi
 import gocept.imapapi.interfaces
 import gocept.imapapi.folder
+import gocept.imapapi.idle
 import gocept.imapapi.imap
+import gocept.imapapi.instrumentation
 
 import sys
 import imaplib
@@ -17,25 +19,112 @@ class Account(object):
 
     zope.interface.implements(gocept.imapapi.interfaces.IAccount)
 
-    def __init__(self, host, port, user, password, ssl=False):
+    def __init__(self, host, port, user, password, ssl=False, pool_size=1,
+                 compress=False, threadsafe=False,
+                 status_ttl=gocept.imapapi.folder.STATUS_TTL,
+                 folder_tree_ttl=gocept.imapapi.folder.FOLDER_TREE_TTL):
         self.host = host
         self.port = port
         self.user = user
         self.password = password
         self.ssl = ssl
+        self.compress = compress
+        self.folder_names = gocept.imapapi.folder.NameCache()
+        self.folder_tree = gocept.imapapi.folder.FolderTree(
+            self, folder_tree_ttl)
+        self.folder_status = gocept.imapapi.folder.StatusCache(status_ttl)
+        self.metrics = gocept.imapapi.instrumentation.Metrics()
+        self.instruments = [self.metrics.record]
+        self.capabilities = gocept.imapapi.imap.Capabilities()
+        if threadsafe:
+            self.pool = gocept.imapapi.imap.CheckoutPool(
+                self.connect, pool_size)
+        else:
+            self.pool = gocept.imapapi.imap.ConnectionPool(
+                self.connect, pool_size)
+        # Log in right away so wrong credentials are reported here.
+        self.pool.get()
+        self.watchers = {}
 
+    @property
+    def server(self):
+        return self.pool.get()
+
+    def release(self):
+        """Give back the connections the current thread has been using.
+
+        With a thread-safe account, each thread keeps its connections until
+        it releases them, e.g. at the end of handling a request. They are
+        then reused by the next thread instead of logging in again.
+
+        """
+        self.pool.release()
+
+    def connect(self):
+        """Open a new authenticated connection to the account."""
         try:
-            self.server = gocept.imapapi.imap.IMAPConnection(host, port, ssl)
+            server = gocept.imapapi.imap.connect(
+                self.host, self.port, self.ssl, self.capabilities)
         except socket.gaierror:
             raise gocept.imapapi.IMAPServerError(sys.exc_info()[1])
         except socket.error:
             raise gocept.imapapi.IMAPServerError(sys.exc_info()[1])
+        server.instrument = self.instrument
 
         try:
-            self.server.login(user, password)
+            server.login(self.user, self.password)
         except imaplib.IMAP4.error:
             raise gocept.imapapi.IMAPConnectionError(sys.exc_info()[1])
+        if self.compress:
+            server.compress()
+        if self.capabilities.resync == 'QRESYNC':
+            # ENABLE must come before any folder is selected; if the server
+            # refuses, changes are found without QRESYNC.
+            server.enable('QRESYNC')
+        return server
+
+    def instrument(self, record):
+        """Pass a record of a completed command to all instruments.
+
+        The account's `metrics` are always updated; other callables may be
+        added to `instruments` to export the records.
+
+        """
+        for instrument in self.instruments:
+            instrument(record)
+
+    def watch(self, folder):
+        """Keep the message count and flags of a folder current using IDLE.
+
+        Returns the watcher whose `poll` method applies changes reported by
+        the server.
+
+        """
+        watcher = self.watchers.get(folder.encoded_path)
+        if watcher is None:
+            watcher = self.watchers[folder.encoded_path] = (
+                gocept.imapapi.idle.IdleWatcher(folder))
+        return watcher
 
     @property
     def folders(self):
         return gocept.imapapi.folder.Folders(self)
+
+    @gocept.imapapi.instrumentation.operation('Account.folder_counts')
+    def folder_counts(self):
+        """Return all folders by path, having fetched their counts at once.
+
+        The number of messages and unread messages, UIDNEXT and UIDVALIDITY
+        of all folders are retrieved in as few round trips as the server
+        allows and cached like the status of a single folder.
+
+        """
+        for path, status in self.folder_tree.status().items():
+            self.folder_status.set(path, status)
+        result = {}
+        folders = self.folders.values()
+        while folders:
+            folder = folders.pop()
+            result[folder.path] = folder
+            folders.extend(folder.folders.values())
+        return result
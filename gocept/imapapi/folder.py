@@ -2,10 +2,19 @@
 # See also LICENSE.txt
 
 import UserDict
+import base64
+import collections
 import email.Parser
+import gocept.imapapi.imap
+import gocept.imapapi.instrumentation
 import gocept.imapapi.interfaces
 import gocept.imapapi.message
+import gocept.imapapi.migrate
 import gocept.imapapi.parser
+import gocept.imapapi.resync
+import re
+import threading
+import time
 import zope.interface
 
 
@@ -19,12 +28,12 @@ class Folder(object):
                  encoded_name=None):
         self._name = name
         self.encoded_name = encoded_name
-        if encoded_name is None and name is not None:
-            self.encoded_name = encode_modified_utf7(name)
-        if name is None and encoded_name is not None:
-            self.name = decode_modified_utf7(encoded_name)
         self.parent = parent
         self._separator = separator
+        if encoded_name is None and name is not None:
+            self.encoded_name = name_cache(parent).encode(name)
+        if name is None and encoded_name is not None:
+            self.name = name_cache(parent).decode(encoded_name)
 
     def __repr__(self):
         repr = super(Folder, self).__repr__()
@@ -33,7 +42,7 @@ class Folder(object):
     def __eq__(self, other):
         if not isinstance(other, Folder):
             return False
-        if self.server is not other.server:
+        if self.account is not other.account:
             return False
         return self.path == other.path
 
@@ -43,24 +52,37 @@ class Folder(object):
     def _set_name(self, name):
         if self.name is None or self.name == name:
             return
-        encoded_name = encode_modified_utf7(name)
+        encoded_name = name_cache(self).encode(name)
         if gocept.imapapi.interfaces.IFolder.providedBy(self.parent):
             encoded_path = self.parent.encoded_path
             encoded_path = '%s%s%s' % (
                 self.parent.encoded_path, self._separator, encoded_name)
         else:
             encoded_path = encoded_name
-        resp = self.server.rename(self.encoded_path, encoded_path)
-        if resp[0] == 'NO':
-            raise KeyError(resp[1][0])
+        self._rename(encoded_path)
         self._name = name
         self.encoded_name = encoded_name
 
     name = property(_get_name, _set_name)
 
+    def _rename(self, encoded_path):
+        tree = folder_tree(self)
+        resp = self.server.rename(self.encoded_path, encoded_path)
+        if resp[0] == 'NO':
+            tree.invalidate()
+            raise KeyError(resp[1][0])
+        tree.rename(self.encoded_path, encoded_path)
+        self.account.folder_status.discard(self.encoded_path)
+
+    @property
+    def account(self):
+        if self.is_subfolder:
+            return self.parent.account
+        return self.parent
+
     @property
     def server(self):
-        return self.parent.server
+        return self.account.pool.get(self.encoded_path)
 
     @property
     def is_subfolder(self):
@@ -105,86 +127,207 @@ class Folder(object):
     def messages(self):
         return gocept.imapapi.message.Messages(self)
 
-    _message_count_cache = None
+    _flag_table = None
+
+    @property
+    def flag_table(self):
+        """The table of flag bits for batches of messages in this folder."""
+        if self._flag_table is None:
+            self._flag_table = gocept.imapapi.message.FlagTable()
+        return self._flag_table
+
+    @property
+    def watcher(self):
+        """The IDLE watcher of this folder if it is being watched."""
+        return self.account.watchers.get(self.encoded_path)
 
     @property
+    @gocept.imapapi.instrumentation.operation('Folder.message_count')
     def message_count(self):
         """Returns the number of messages in the folder.
 
-        The number is cached during the transaction. Since RfC 3501 states
-        that the STATUS command should not be used on the currently selected
-        mail box, the same value will be set when selecting the folder.
+        If the folder is watched, the watcher knows the current number.
+        Otherwise, it is taken from the folder's status, see `status`.
 
         """
-        if self._message_count_cache is None:
-            code, data = self.server.status(self.encoded_path, "(MESSAGES)")
-            assert code == 'OK', '%s %r' % (code, data)
-            self._message_count_cache = (
-                gocept.imapapi.parser.status(data[0])['MESSAGES'])
-        return self._message_count_cache
+        watcher = self.watcher
+        if watcher is not None:
+            return watcher.message_count
+        return self.status(('MESSAGES',))['MESSAGES']
 
     @property
+    @gocept.imapapi.instrumentation.operation('Folder.unread_message_count')
     def unread_message_count(self):
-        # XXX RFC3501 says you SHOULD NOT do STATUS on the currently selected
-        # mailbox since it might be slow, see #8449.
-        code, data = self.server.status(self.encoded_path, "(UNSEEN)")
+        watcher = self.watcher
+        if watcher is not None:
+            return watcher.unread_message_count
+        return self.status(('UNSEEN',))['UNSEEN']
+
+    @gocept.imapapi.instrumentation.operation('Folder.status')
+    def status(self, items=None):
+        """Return the numbers of messages and unread messages, UIDNEXT and
+        UIDVALIDITY of the folder, or those of them given as `items`.
+
+        Values not cached yet are fetched by a single STATUS command and
+        cached by the account for `status_ttl` seconds; UIDVALIDITY is kept
+        for the whole session. Selecting the folder takes the values from the
+        SELECT response instead. Since RfC 3501 states that the STATUS
+        command should not be used on the currently selected mail box (see
+        #8449), unread messages of a selected folder are counted by SEARCH.
+        Our own writes to the folder update the number of messages and drop
+        the values they may have changed.
+
+        """
+        if items is None:
+            items = STATUS_ITEMS
+        cache = self.account.folder_status
+        status = cache.get(self.encoded_path)
+        missing = [item for item in items if item not in status]
+        if not missing:
+            return status
+        server = self.server
+        if ('UNSEEN' in missing and
+            server.selected_path == self.encoded_path):
+            status['UNSEEN'] = self._count_unseen(server)
+            missing.remove('UNSEEN')
+        if missing:
+            code, data = server.status(
+                self.encoded_path, '(%s)' % ' '.join(missing))
+            assert code == 'OK', '%s %r' % (code, data)
+            status.update(gocept.imapapi.parser.status(data[0]))
+        cache.update(self.encoded_path, status)
+        return status
+
+    def _count_unseen(self, server):
+        pipeline = server.pipeline()
+        if server.capabilities.search == 'ESEARCH':
+            pipeline.uid('SEARCH', 'RETURN', '(COUNT)', 'UNSEEN')
+        else:
+            pipeline.uid('SEARCH', 'UNSEEN')
+        code, data = pipeline.execute()[0]
         assert code == 'OK', '%s %r' % (code, data)
-        return gocept.imapapi.parser.status(data[0])['UNSEEN']
+        if server.capabilities.search == 'ESEARCH':
+            return gocept.imapapi.parser.esearch(data).get('COUNT', 0)
+        return len(gocept.imapapi.parser.search(data))
+
+    def _written(self, added=0):
+        """Update the cached status after writing to the folder.
+
+        `added` is the number of messages added, or removed if negative,
+        or None if not known.
+
+        """
+        self.account.folder_status.written(self.encoded_path, added)
 
-    def _select(self):
+    def _select(self, pipeline=None):
         """Selects the folder as the current folder of the connection.
 
         Caches the number of messages in the folder. If the folder is already
-        selected, this is a no-op.
+        selected, this is a no-op. If a pipeline is given, the SELECT command
+        is queued on it instead of being sent right away.
 
         """
-        if self.server.selected_path != self.encoded_path:
+        if self.server.selected_path == self.encoded_path:
+            return
+        if pipeline is None:
             code, data = self.server.select(self.encoded_path)
-            assert code == 'OK', 'Unexpected status code %s' % code
-            self._message_count_cache = int(data[0])
+            self._selected(code, data)
+        else:
+            pipeline.select(self.encoded_path, callback=self._selected)
+
+    def _selected(self, code, data):
+        assert code == 'OK', 'Unexpected status code %s' % code
+        status = {'MESSAGES': int(data[0])}
+        responses = self.server.untagged_responses
+        for item in ('UIDNEXT', 'UIDVALIDITY'):
+            if responses.get(item):
+                status[item] = int(responses[item][-1])
+        self.account.folder_status.update(self.encoded_path, status)
 
     def _delete_recursive(self):
         for key in self.folders.keys():
             self.folders[key]._delete_recursive()
+        tree = folder_tree(self)
         code, data = self.server.delete(self.encoded_path)
         if code != 'OK':
+            tree.invalidate()
             raise RuntimeError(self.path, gocept.imapapi.parser.unsplit(data))
-
-    _uidvalidity = None
+        tree.remove(self.encoded_path)
+        self.account.folder_status.discard(self.encoded_path)
 
     @property
+    @gocept.imapapi.instrumentation.operation('Folder.uidvalidity')
     def uidvalidity(self):
         """Retrieve the UID validity value of the folder.
 
         This number must stay the same throughout a session.
 
         """
-        if self._uidvalidity is None:
-            code, data = self.server.status(
-                self.encoded_path, "(UIDVALIDITY)")
-            self._uidvalidity = (
-                gocept.imapapi.parser.status(data[0])['UIDVALIDITY'])
-        return self._uidvalidity
-
-    def move(self, target):
-        if target.server is self.server:
+        return self.status(('UIDVALIDITY',))['UIDVALIDITY']
+
+    @property
+    @gocept.imapapi.instrumentation.operation('Folder.uidnext')
+    def uidnext(self):
+        """Retrieve the UID the next message added to the folder will get at
+        least.
+
+        """
+        return self.status(('UIDNEXT',))['UIDNEXT']
+
+    @gocept.imapapi.instrumentation.operation('Folder.changes_since')
+    def changes_since(self, state=None):
+        """Return what changed in the folder since a state.
+
+        Without a state, all messages are reported as new. The state to pass
+        next time is the `state` attribute of the changes returned, see
+        `gocept.imapapi.resync`.
+
+        """
+        return gocept.imapapi.resync.changes_since(self, state)
+
+    @gocept.imapapi.instrumentation.operation('Folder.move')
+    def move(self, target, progress=None):
+        """Move the folder into another folder or account.
+
+        Within an account, the folder is renamed. Moving it to another
+        account copies its messages, see `gocept.imapapi.migrate`. Given a
+        progress, a move that has been interrupted may be repeated: messages
+        copied before are skipped and folders already created are reused.
+
+        """
+        if gocept.imapapi.interfaces.IAccount.providedBy(target):
+            account = target
+        else:
+            account = target.account
+        if account is self.account:
             if gocept.imapapi.interfaces.IAccount.providedBy(target):
                 encoded_path = self.encoded_name
             else:
                 encoded_path = '%s%s%s' % (
                     target.encoded_path, self.separator, self.encoded_name)
-            resp = self.server.rename(self.encoded_path, encoded_path)
-            if resp[0] == 'NO':
-                raise KeyError(resp[1][0])
+            self._rename(encoded_path)
             self.parent = target
         else:
-            new = target.folders[self.name] = Folder()
-            for folder in self.folders.values():
-                folder.move(new)
-            for message in self.messages:
-                new.messages.add(message)
+            connections = gocept.imapapi.migrate.Connections(
+                self.account, account)
+            try:
+                self._copy(target, progress, connections)
+            finally:
+                connections.close()
             del self.parent.folders[self.name]
 
+    def _copy(self, target, progress, connections):
+        # Copy the folder with its subfolders and messages to another
+        # account.
+        if progress is None or self.name not in target.folders:
+            target.folders[self.name] = Folder()
+        # Look the folder up again so it knows its separator.
+        new = target.folders[self.name]
+        for folder in self.folders.values():
+            folder._copy(new, progress, connections)
+        gocept.imapapi.migrate.copy_messages(
+            self, new, progress, connections)
+
 
 class Folders(UserDict.DictMixin):
     """A mapping object for accessing folders located in IFolderContainers.
@@ -195,47 +338,44 @@ class Folders(UserDict.DictMixin):
     def __init__(self, container):
         self.container = container
 
-    _keys = None
-
+    @gocept.imapapi.instrumentation.operation('Folders.keys')
     def keys(self):
-        if self._keys is not None:
-            return self._keys
-
         if gocept.imapapi.interfaces.IFolder.providedBy(self.container):
-            if self.container.separator is not None:
-                path = self.container.encoded_path + self.container.separator
-            else:
+            if self.container.separator is None:
                 # We have a non-hierarchical folder.
                 return []
+            path = self.container.encoded_path
         else:
-            path = ''
-
-        code, data = self.container.server.list('', path + '%')
-        assert code == 'OK'
-
-        result = []
-        for response in gocept.imapapi.parser.unsplit(data):
-            if response is None:
-                continue
-            flags, sep, name = gocept.imapapi.parser.mailbox_list(response)
-            # XXX Looping the separator this way is kind of icky.
-            self.separator = sep
-            if sep is not None:
-                name = name.split(sep)[-1]
-            name = decode_modified_utf7(name)
-            result.append(name)
-        result.sort()
-
-        self._keys = result
-        return result
+            path = None
+        return folder_tree(self.container).keys(path)
 
+    @gocept.imapapi.instrumentation.operation('Folders.__getitem__')
     def __getitem__(self, key):
         key = unicode(key)
-        if key not in self.keys():
+        path = self._path(key)
+        if path is None:
             raise KeyError(key)
-        # XXX Part two of the icky separator communication
-        return Folder(key, self.container, self.separator)
+        separator = folder_tree(self.container).separator(path)
+        return Folder(key, self.container, separator)
+
+    def __contains__(self, key):
+        return self._path(unicode(key)) is not None
+
+    def _path(self, key):
+        """Return the encoded path of a sub-folder if it exists."""
+        encoded_key = name_cache(self.container).encode(key)
+        if gocept.imapapi.interfaces.IFolder.providedBy(self.container):
+            separator = self.container.separator
+            if separator is None:
+                return None
+            path = self.container.encoded_path + separator + encoded_key
+        else:
+            path = encoded_key
+        if path not in folder_tree(self.container):
+            return None
+        return path
 
+    @gocept.imapapi.instrumentation.operation('Folders.__setitem__')
     def __setitem__(self, key, folder):
         assert isinstance(key, unicode)
         if not isinstance(folder, Folder):
@@ -244,29 +384,31 @@ class Folders(UserDict.DictMixin):
             folder.parent is not None):
             raise ValueError('Can only assign unattached folder objects.')
 
-        encoded_key = encode_modified_utf7(key)
+        encoded_key = name_cache(self.container).encode(key)
         if gocept.imapapi.interfaces.IFolder.providedBy(self.container):
             path = (self.container.encoded_path + self.container.separator +
                     encoded_key)
         else:
             path = encoded_key
 
+        tree = folder_tree(self.container)
         code, data = self.container.server.create(path)
         if code == 'NO':
+            # Someone else may have created the folder meanwhile.
+            tree.invalidate()
             raise KeyError(
                 "Could not create folder '%s': %s" % (path, data[0]))
         assert code == 'OK'
+        tree.add(path)
 
         folder._name = key
         folder.encoded_name = encoded_key
         folder.parent = self.container
-        if self._keys is not None:
-            self._keys.append(key)
-            self._keys.sort()
 
+    @gocept.imapapi.instrumentation.operation('Folders.__delitem__')
     def __delitem__(self, key):
         key = unicode(key)
-        if key not in self.keys():
+        if key not in self:
             raise KeyError(key)
         if (gocept.imapapi.interfaces.IAccount.providedBy(self.container)
                 and key.upper() == u'INBOX'):
@@ -274,6 +416,482 @@ class Folders(UserDict.DictMixin):
         self[key]._delete_recursive()
 
 
+# The values fetched for all folders at once by `FolderTree.status`.
+STATUS_ITEMS = ('MESSAGES', 'UNSEEN', 'UIDNEXT', 'UIDVALIDITY')
+
+# The number of seconds folder status values are cached by an account.
+STATUS_TTL = 5
+
+# The number of STATUS commands sent at once if the server doesn't support
+# LIST-STATUS.
+STATUS_BATCH_SIZE = 100
+
+# The number of seconds the folder hierarchy is cached by an account before
+# it is listed again to notice changes made by other clients.
+FOLDER_TREE_TTL = 60
+
+
+class FolderTree(object):
+    """An index of all folders of an account by their encoded path.
+
+    The whole hierarchy is read with a single `LIST "" "*"` when it is first
+    needed, so listing and looking up folders at any depth doesn't cost a
+    round trip each. Creating, renaming and deleting folders through the API
+    keeps the index up to date. The hierarchy is read again `ttl` seconds
+    after it was loaded, so changes made by other clients show up; a TTL of
+    0 turns caching off. `invalidate` makes it read the hierarchy again the
+    next time it is needed.
+
+    """
+
+    def __init__(self, account, ttl=FOLDER_TREE_TTL):
+        self.account = account
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        self.invalidate()
+
+    def invalidate(self):
+        self.lock.acquire()
+        try:
+            # Encoded path -> (flags, separator)
+            self.folders = None
+            # Encoded path of the parent, None for the top level ->
+            # {encoded name: name}
+            self.children = None
+            self.sorted_keys = {}
+            self.delimiter = None
+            self.loaded_at = None
+        finally:
+            self.lock.release()
+
+    @property
+    def loaded(self):
+        return (self.folders is not None and
+                time.time() - self.loaded_at < self.ttl)
+
+    def _load(self):
+        # Called with the lock held.
+        if self.loaded:
+            return
+        code, data = self.account.server.list('', '*')
+        assert code == 'OK', '%s %r' % (code, data)
+        self._update(data)
+
+    def _update(self, data):
+        # Called with the lock held.
+        self.folders = {}
+        self.children = {}
+        self.sorted_keys = {}
+        self.delimiter = None
+        self.loaded_at = time.time()
+        for response in gocept.imapapi.parser.unsplit(data):
+            if response is None:
+                continue
+            flags, sep, name = gocept.imapapi.parser.mailbox_list(response)
+            self._add(name, flags, sep)
+
+    def _selectable(self, path):
+        flags = set(str(flag).upper() for flag in self.folders[path][0])
+        return not flags & set(['\\NOSELECT', '\\NONEXISTENT'])
+
+    def _split(self, path, separator):
+        if separator is not None and separator in path:
+            return path.rsplit(separator, 1)
+        return None, path
+
+    def _add(self, path, flags, separator):
+        parent, name = self._split(path, separator)
+        if parent is not None and parent not in self.folders:
+            # Servers need not list the parents of folders that don't exist
+            # themselves, but they are part of the hierarchy nevertheless.
+            self._add(parent, ('\\Noselect',), separator)
+        self.folders[path] = (flags, separator)
+        self.children.setdefault(parent, {})[name] = (
+            name_cache(self.account).decode(name))
+        self.sorted_keys.pop(parent, None)
+        if self.delimiter is None:
+            self.delimiter = separator
+
+    def _remove(self, path):
+        flags, separator = self.folders.pop(path)
+        for name in self.children.pop(path, {}).keys():
+            self._remove(path + separator + name)
+        self.sorted_keys.pop(path, None)
+        parent, name = self._split(path, separator)
+        self.children.get(parent, {}).pop(name, None)
+        self.sorted_keys.pop(parent, None)
+
+    def _walk(self, path):
+        flags, separator = self.folders[path]
+        yield path, flags, separator
+        for name in self.children.get(path, {}).keys():
+            for item in self._walk(path + separator + name):
+                yield item
+
+    def keys(self, path=None):
+        """Return the sorted names of the sub-folders of a folder given by
+        its encoded path, or of the top-level folders.
+
+        """
+        self.lock.acquire()
+        try:
+            self._load()
+            keys = self.sorted_keys.get(path)
+            if keys is None:
+                keys = self.sorted_keys[path] = sorted(
+                    self.children.get(path, {}).values())
+            return list(keys)
+        finally:
+            self.lock.release()
+
+    def __contains__(self, path):
+        self.lock.acquire()
+        try:
+            self._load()
+            return path in self.folders
+        finally:
+            self.lock.release()
+
+    def separator(self, path):
+        self.lock.acquire()
+        try:
+            self._load()
+            return self.folders[path][1]
+        finally:
+            self.lock.release()
+
+    def flags(self, path):
+        self.lock.acquire()
+        try:
+            self._load()
+            return self.folders[path][0]
+        finally:
+            self.lock.release()
+
+    def status(self, items=None):
+        """Return the status of all folders by encoded path.
+
+        Uses a single LIST command if the server supports LIST-STATUS
+        (RfC 5819), which also reads the hierarchy again. Otherwise, STATUS
+        commands are pipelined in batches of STATUS_BATCH_SIZE folders.
+
+        """
+        if items is None:
+            items = STATUS_ITEMS
+        server = self.account.server
+        result = {}
+        if server.capabilities.status == 'LIST-STATUS':
+            code, data, statuses = server.list_status('*', items)
+            assert code == 'OK', '%s %r' % (code, data)
+            self.lock.acquire()
+            try:
+                self._update(data)
+            finally:
+                self.lock.release()
+            for response in gocept.imapapi.parser.unsplit(statuses):
+                if response is None:
+                    continue
+                name, status = gocept.imapapi.parser.mailbox_status(response)
+                result[name] = status
+            return result
+
+        self.lock.acquire()
+        try:
+            self._load()
+            paths = sorted(path for path in self.folders
+                           if self._selectable(path))
+        finally:
+            self.lock.release()
+        items = '(%s)' % ' '.join(items)
+        for start in xrange(0, len(paths), STATUS_BATCH_SIZE):
+            batch = paths[start:start + STATUS_BATCH_SIZE]
+            pipeline = server.pipeline()
+            for path in batch:
+                pipeline.status(path, items)
+            for path, (code, data) in zip(batch, pipeline.execute()):
+                if code != 'OK':
+                    # The folder has been deleted by another client.
+                    continue
+                result[path] = gocept.imapapi.parser.status(data[0])
+        return result
+
+    def add(self, path):
+        """Record that a folder has been created."""
+        self.lock.acquire()
+        try:
+            if self.loaded and path not in self.folders:
+                self._add(path, (), self.delimiter)
+        finally:
+            self.lock.release()
+
+    def remove(self, path):
+        """Record that a folder and its sub-folders have been deleted."""
+        self.lock.acquire()
+        try:
+            if self.loaded and path in self.folders:
+                self._remove(path)
+        finally:
+            self.lock.release()
+
+    def rename(self, old, new):
+        """Record that a folder has been renamed along with its sub-folders.
+
+        """
+        self.lock.acquire()
+        try:
+            if not self.loaded:
+                return
+            if old not in self.folders or old.upper() == 'INBOX':
+                # Renaming the INBOX moves its messages but leaves an empty
+                # INBOX in place, so just read the hierarchy again.
+                self.invalidate()
+                return
+            moved = list(self._walk(old))
+            self._remove(old)
+            for path, flags, separator in moved:
+                self._add(new + path[len(old):], flags, separator)
+        finally:
+            self.lock.release()
+
+
+class StatusCache(object):
+    """Status values of an account's folders by encoded path.
+
+    Values expire `ttl` seconds after they were fetched; a TTL of 0 turns
+    caching off. UIDVALIDITY must stay the same throughout a session, so it
+    is kept until the folder is discarded:
+
+    >>> cache = StatusCache(ttl=60)
+    >>> cache.set('INBOX', {'MESSAGES': 3, 'UNSEEN': 1, 'UIDVALIDITY': 7})
+    >>> sorted(cache.get('INBOX').items())
+    [('MESSAGES', 3), ('UIDVALIDITY', 7), ('UNSEEN', 1)]
+    >>> cache.get('Bar')
+    {}
+
+    Writing to a folder updates the number of messages and drops the values
+    the write may have changed:
+
+    >>> cache.written('INBOX', 2)
+    >>> sorted(cache.get('INBOX').items())
+    [('MESSAGES', 5), ('UIDVALIDITY', 7)]
+    >>> cache.entries['INBOX'][0] -= 60
+    >>> cache.get('INBOX')
+    {'UIDVALIDITY': 7}
+    >>> cache.discard('INBOX')
+    >>> cache.get('INBOX')
+    {}
+
+    """
+
+    def __init__(self, ttl=STATUS_TTL):
+        self.ttl = ttl
+        # Encoded path -> [time fetched, status]
+        self.entries = {}
+        # Encoded path -> UIDVALIDITY
+        self.uidvalidity = {}
+        self.lock = threading.Lock()
+
+    def _entry(self, path):
+        # Called with the lock held.
+        entry = self.entries.get(path)
+        if entry is not None and time.time() - entry[0] >= self.ttl:
+            del self.entries[path]
+            entry = None
+        return entry
+
+    def _split(self, path, status):
+        # Called with the lock held.
+        status = dict(status)
+        if 'UIDVALIDITY' in status:
+            self.uidvalidity[path] = status.pop('UIDVALIDITY')
+        return status
+
+    def get(self, path):
+        self.lock.acquire()
+        try:
+            entry = self._entry(path)
+            status = {}
+            if entry is not None:
+                status.update(entry[1])
+            if path in self.uidvalidity:
+                status['UIDVALIDITY'] = self.uidvalidity[path]
+            return status
+        finally:
+            self.lock.release()
+
+    def set(self, path, status):
+        self.lock.acquire()
+        try:
+            self.entries[path] = [time.time(), self._split(path, status)]
+        finally:
+            self.lock.release()
+
+    def update(self, path, status):
+        """Add values to those of a folder, which expire with them."""
+        self.lock.acquire()
+        try:
+            status = self._split(path, status)
+            entry = self._entry(path)
+            if entry is None:
+                self.entries[path] = [time.time(), status]
+            else:
+                entry[1].update(status)
+        finally:
+            self.lock.release()
+
+    def written(self, path, added=0):
+        self.lock.acquire()
+        try:
+            entry = self._entry(path)
+            if entry is None:
+                return
+            status = {}
+            if 'MESSAGES' in entry[1] and added is not None:
+                status['MESSAGES'] = entry[1]['MESSAGES'] + added
+            entry[1] = status
+        finally:
+            self.lock.release()
+
+    def discard(self, path):
+        self.lock.acquire()
+        try:
+            self.entries.pop(path, None)
+            self.uidvalidity.pop(path, None)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+            self.uidvalidity.clear()
+        finally:
+            self.lock.release()
+
+
+def folder_tree(container):
+    """Return the folder tree of the account holding a container."""
+    while gocept.imapapi.interfaces.IFolder.providedBy(container):
+        container = container.parent
+    return container.folder_tree
+
+
+def folder_status(folders, items=None):
+    """Return the status of many folders, which may be of different accounts.
+
+    Values not cached yet are fetched by a pipeline of STATUS commands per
+    account. The pipelines of all accounts are sent before any of their
+    responses is read (see `gocept.imapapi.imap.execute`), so the whole
+    batch costs about one round trip to the slowest server. Returns the
+    status of each folder in the order given, see `Folder.status`.
+
+    """
+    if items is None:
+        items = STATUS_ITEMS
+    pipelines = {}
+    results = []
+    for folder in folders:
+        status = folder.account.folder_status.get(folder.encoded_path)
+        results.append(status)
+        missing = [item for item in items if item not in status]
+        if not missing:
+            continue
+        pipeline = pipelines.get(folder.account)
+        if pipeline is None:
+            # A single connection per account sends all of its STATUS
+            # commands, rather than one connection per folder.
+            pipeline = pipelines[folder.account] = (
+                folder.account.pool.get().pipeline())
+        if pipeline.connection.selected_path == folder.encoded_path:
+            # STATUS should not be used on the selected mailbox (#8449).
+            status.update(folder.status(items))
+            continue
+        pipeline.status(folder.encoded_path, '(%s)' % ' '.join(missing),
+                        callback=_status_fetched(folder, status))
+    gocept.imapapi.imap.execute(pipelines.values())
+    return results
+
+
+def _status_fetched(folder, status):
+    def callback(code, data):
+        assert code == 'OK', '%s %r' % (code, data)
+        status.update(gocept.imapapi.parser.status(data[0]))
+        folder.account.folder_status.update(folder.encoded_path, status)
+    return callback
+
+
+FOLDER_NAME_CACHE_SIZE = 4096
+
+
+class NameCache(object):
+    r"""A bounded LRU cache of encoded and decoded folder names.
+
+    Each account keeps one of these so listing folders and building folder
+    objects doesn't run the modified UTF-7 codec for the same names again and
+    again:
+
+    >>> names = NameCache(size=2)
+    >>> names.encode(u'\xe4')
+    '&AOQ-'
+    >>> names.decode('&APY-')
+    u'\xf6'
+    >>> names.encode(u'\xfc')
+    '&APw-'
+    >>> names.encode(u'\xe4')
+    '&AOQ-'
+    >>> names.encoded.keys()
+    [u'\xfc', u'\xe4']
+
+    The least recently used name is dropped when the cache is full:
+
+    >>> names.encode(u'a')
+    'a'
+    >>> names.encoded.keys()
+    [u'\xe4', u'a']
+
+    """
+
+    def __init__(self, size=FOLDER_NAME_CACHE_SIZE):
+        self.size = size
+        self.encoded = collections.OrderedDict()
+        self.decoded = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def encode(self, name):
+        return self._lookup(self.encoded, name, encode_modified_utf7)
+
+    def decode(self, bytes):
+        return self._lookup(self.decoded, bytes, decode_modified_utf7)
+
+    def _lookup(self, cache, key, codec):
+        self.lock.acquire()
+        try:
+            try:
+                value = cache.pop(key)
+            except KeyError:
+                value = codec(key)
+                if len(cache) >= self.size:
+                    cache.popitem(last=False)
+            cache[key] = value
+            return value
+        finally:
+            self.lock.release()
+
+
+_default_names = NameCache()
+
+
+def name_cache(container):
+    """Return the folder name cache of the account holding a container."""
+    while gocept.imapapi.interfaces.IFolder.providedBy(container):
+        container = container.parent
+    return getattr(container, 'folder_names', _default_names)
+
+
+# Runs of printable ASCII characters and runs of anything else.
+UNICODE_RUNS = re.compile(u'([\x20-\x7e]+)|[^\x20-\x7e]+')
+
+
 def encode_modified_utf7(text):
     r"""Modified UTF-7 encoding as specified in RfC 3501, section 5.1.3.
 
@@ -283,24 +901,29 @@ def encode_modified_utf7(text):
     >>> encode_modified_utf7(u'as-d\xe4f')
     'as-d&AOQ-f'
 
+    >>> encode_modified_utf7(u'R&D')
+    'R&-D'
+
+    Characters outside the printable ASCII range are always base64 encoded,
+    and the base64 alphabet uses a comma instead of a slash:
+
+    >>> encode_modified_utf7(u'a\tb')
+    'a&AAk-b'
+
+    >>> encode_modified_utf7(u'\ufbff\ufeff')
+    '&+,,+,w-'
+
     """
-    def encode_buffer(buffer):
-        return buffer.encode('utf7').replace('/', ',').replace('+', '&')
-
-    bytes = ''
-    buffer = u''
-    for c in text:
-        if u'\x20' <= c <= u'\x7e':
-            bytes += encode_buffer(buffer)
-            buffer = u''
-            if c == u'&':
-                bytes += '&-'
-            else:
-                bytes += c.encode('ascii')
+    result = []
+    append = result.append
+    for match in UNICODE_RUNS.finditer(text):
+        run = match.group()
+        if match.group(1) is not None:
+            append(run.encode('ascii').replace('&', '&-'))
         else:
-            buffer += c
-    bytes += encode_buffer(buffer)
-    return bytes
+            encoded = base64.b64encode(run.encode('utf-16-be'))
+            append('&%s-' % encoded.rstrip('=').replace('/', ','))
+    return ''.join(result)
 
 
 def decode_modified_utf7(bytes):
@@ -311,11 +934,23 @@ def decode_modified_utf7(bytes):
     >>> decode_modified_utf7('&AOQA9gD8-')
     u'\xe4\xf6\xfc'
 
+    >>> decode_modified_utf7('R&-D')
+    u'R&D'
+
+    >>> decode_modified_utf7('&+,,+,w-')
+    u'\ufbff\ufeff'
+
     We don't break on junk:
 
     >>> decode_modified_utf7('\xef')
     u'\\xef'
 
+    >>> decode_modified_utf7('a&AOQ')
+    u'a&AOQ'
+
+    >>> decode_modified_utf7('&AO-')
+    u'&AO-'
+
     Regression: Strings which contain a UTF7-encoded character somewhere after
     a dash used to be decoded wrong:
 
@@ -323,25 +958,33 @@ def decode_modified_utf7(bytes):
     u'as-d\xe4f'
 
     """
-    def decode_utf7(buffer):
-        return buffer.replace('&', '+').replace(',', '/').decode('utf7')
-
-    def decode_ascii(buffer):
-        try:
-            return buffer.decode('ascii')
-        except UnicodeDecodeError:
-            return unicode(repr(buffer)[1:-1])
-
-    text = u''
-    while '&' in bytes:
-        start = bytes.index('&')
-        text += decode_ascii(bytes[:start])
-
-        stop = bytes.index('-', start) + 1
-        if stop == start + 2:
-            text += u'&'
+    # Shifted sequences can't contain an ampersand, so each chunk after the
+    # first one starts with a shifted sequence.
+    chunks = bytes.split('&')
+    result = [_decode_ascii(chunks[0])]
+    append = result.append
+    for chunk in chunks[1:]:
+        stop = chunk.find('-')
+        if stop == -1:
+            append(_decode_ascii('&' + chunk))
+            continue
+        if stop == 0:
+            append(u'&')
         else:
-            text += decode_utf7(bytes[start:stop])
-        bytes = bytes[stop:]
-    text += decode_ascii(bytes)
-    return text
+            append(_decode_base64(chunk[:stop]))
+        append(_decode_ascii(chunk[stop + 1:]))
+    return u''.join(result)
+
+
+def _decode_ascii(bytes):
+    try:
+        return bytes.decode('ascii')
+    except UnicodeDecodeError:
+        return unicode(repr(bytes)[1:-1])
+
+
+def _decode_base64(encoded):
+    try:
+        return ('+%s-' % encoded.replace(',', '/')).decode('utf7')
+    except UnicodeDecodeError:
+        return _decode_ascii('&%s-' % encoded)
@@ -0,0 +1,121 @@
+# Copyright (c) 2011 gocept gmbh & co. kg
+# See also LICENSE.txt
+"""Keep folder caches up to date with changes pushed by the server."""
+
+import gocept.imapapi.parser
+
+
+class IdleWatcher(object):
+    """Watches a folder over a dedicated connection using IDLE (RfC 2177).
+
+    The watcher knows the UID of each message by its sequence number and the
+    flags of each message by its UID. Untagged EXISTS, EXPUNGE (or VANISHED)
+    and FETCH responses received while polling update this information in
+    place, so message counts and flags of the folder's messages stay current
+    without sending STATUS or FETCH commands on the account's other
+    connections. The account's cached status of the folder is replaced by
+    the counts the watcher knows whenever something changed.
+
+    """
+
+    def __init__(self, folder):
+        self.account = folder.account
+        self.path = folder.encoded_path
+        self.connection = self.account.connect()
+        self.uids = []
+        self.flags = {}
+        code, data = self.connection.select(self.path)
+        assert code == 'OK', '%s %r' % (code, data)
+        self._fetch_new(int(data[0]))
+
+    @property
+    def message_count(self):
+        return len(self.uids)
+
+    @property
+    def unread_message_count(self):
+        return len([uid for uid in self.uids
+                    if '\\Seen' not in self.flags.get(uid, ())])
+
+    def shared_flags(self, uid, flags):
+        """Return the set of flags of a message that is kept up to date.
+
+        The set is updated in place with the given flags which have just been
+        fetched from the server.
+
+        """
+        shared = self.flags.setdefault(uid, set())
+        shared.clear()
+        shared.update(flags)
+        return shared
+
+    def poll(self, timeout=0):
+        """Wait up to `timeout` seconds for changes and apply them.
+
+        Returns whether anything changed.
+
+        """
+        events = self.connection.idle(timeout)
+        for typ, data in events:
+            if typ == 'EXPUNGE':
+                uid = self.uids.pop(int(data) - 1)
+                self.flags.pop(uid, None)
+            elif typ == 'VANISHED':
+                # Sent instead of EXPUNGE once QRESYNC has been enabled.
+                for uid in gocept.imapapi.parser.vanished([data]):
+                    if uid in self.uids:
+                        self.uids.remove(uid)
+                    self.flags.pop(uid, None)
+            elif typ == 'EXISTS':
+                count = int(data)
+                if count > len(self.uids):
+                    self.uids.extend([None] * (count - len(self.uids)))
+            elif typ == 'FETCH':
+                self._update(data)
+        self._fetch_new(len(self.uids))
+        if events:
+            self._changed()
+        return bool(events)
+
+    def _changed(self):
+        # UIDNEXT may have changed, too, so it is dropped from the cache.
+        status = {'MESSAGES': self.message_count}
+        if None not in self.uids:
+            status['UNSEEN'] = self.unread_message_count
+        self.account.folder_status.set(self.path, status)
+
+    def _update(self, line):
+        number = int(line.split(None, 1)[0])
+        data = gocept.imapapi.parser.fetch(line)
+        if 'UID' in data:
+            self.uids[number - 1] = data['UID']
+        uid = self.uids[number - 1]
+        if uid is not None and 'FLAGS' in data:
+            self.shared_flags(uid, data['FLAGS'])
+
+    def _fetch_new(self, count):
+        """Fetch UIDs and flags of messages only known by their number."""
+        if count > len(self.uids):
+            self.uids.extend([None] * (count - len(self.uids)))
+        missing = None
+        while None in self.uids and self.uids.count(None) != missing:
+            missing = self.uids.count(None)
+            start = self.uids.index(None) + 1
+            code, data = self.connection.fetch(
+                '%s:%s' % (start, len(self.uids)), '(UID FLAGS)')
+            assert code == 'OK', '%s %r' % (code, data)
+            for line in gocept.imapapi.parser.unsplit(data):
+                if line is not None:
+                    self._update(line)
+            # More messages may have arrived in the meantime.
+            exists = self.connection.server.untagged_responses.pop(
+                'EXISTS', None)
+            if exists:
+                count = int(exists[-1])
+                if count > len(self.uids):
+                    self.uids.extend([None] * (count - len(self.uids)))
+
+    def close(self):
+        """Stop watching and log out the watcher's connection."""
+        self.account.watchers.pop(self.path, None)
+        self.connection.logout()
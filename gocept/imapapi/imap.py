@@ -3,28 +3,515 @@
 # See also LICENSE.txt
 """Wrapper for IMAP connections to allow some experiments."""
 
+import collections
+import gocept.imapapi.instrumentation
+import gocept.imapapi.parser
 import imaplib
+import itertools
 import logging
+import re
+import select
+import socket
+import sys
+import tempfile
+import threading
+import time
+import zlib
 
 logger = logging.getLogger('gocept.imapapi.imap')
 
+# Literals of at least this size are not read into memory but spooled to a
+# temporary file while reading them from the connection.
+LITERAL_SPOOL_THRESHOLD = 1 << 20
+LITERAL_BLOCK_SIZE = 1 << 16
 
-def callable_proxy(conn, name, callable):
+# Non-synchronizing literals of at most this size may be sent to servers
+# that announce LITERAL- (RfC 7888).
+LITERAL_MINUS_LIMIT = 4096
+
+# Unauthenticated connections kept ready by a warm pool are closed after this
+# many seconds, before servers time out waiting for a login.
+WARM_CONNECTION_MAX_AGE = 30
+
+# Messages appended with a single command if the server supports MULTIAPPEND
+# (RfC 3502), and APPEND commands sent before reading the oldest completion.
+MULTIAPPEND_BATCH_SIZE = 100
+APPEND_WINDOW = 32
+
+# Untagged responses reported by `IMAPConnection.idle`. VANISHED replaces
+# EXPUNGE once QRESYNC has been enabled.
+IDLE_EVENTS = frozenset(['EXISTS', 'EXPUNGE', 'FETCH', 'VANISHED'])
+
+# RfC 2177 IDLE, RfC 4978 COMPRESS, RfC 5161 ENABLE and RfC 6851 MOVE are
+# not known to imaplib.
+imaplib.Commands.setdefault('IDLE', ('SELECTED',))
+imaplib.Commands.setdefault('ENABLE', ('AUTH', 'SELECTED'))
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+imaplib.Commands.setdefault('MOVE', ('SELECTED',))
+
+CAPABILITY_CODE = re.compile(r'\[CAPABILITY ([^\]]*)\]', re.IGNORECASE)
+
+
+def callable_proxy(conn, name, callable, record=True):
     def proxy(*args, **kw):
-        log_args = args
-        if name.startswith('login'):
-            user, password = args
-            log_args = (user, '****')
-        logger.debug('%s:%s: %s(%s, %s)' % (
-                conn.server.host, conn.server.port, name, log_args, kw))
-        try:
-            return callable(*args, **kw)
+        # A command must not interleave with responses still being streamed.
+        conn._finish_stream()
+        if logger.isEnabledFor(logging.DEBUG):
+            log_args = args
+            if name.startswith('login'):
+                user, password = args
+                log_args = (user, '****')
+            logger.debug('%s:%s: %s(%s, %s)' % (
+                    conn.server.host, conn.server.port, name, log_args, kw))
+        if not record or not conn.instrumented:
+            try:
+                return callable(*args, **kw)
+            except:
+                logger.debug('Error in %s' % name, exc_info=True)
+                raise
+        command = command_name(name, args)
+        mailbox = command_mailbox(conn, command, args)
+        server = conn.server
+        start = time.time()
+        received = server.bytes_received
+        sent = server.bytes_sent
+        continuations = server.continuations
+        status = 'ERROR'
+        try:
+            result = callable(*args, **kw)
+            if isinstance(result, tuple):
+                status = result[0]
+            return result
         except:
             logger.debug('Error in %s' % name, exc_info=True)
             raise
+        finally:
+            # Waiting for a continuation to send a literal costs another
+            # round trip.
+            conn._record(command, mailbox, status, time.time() - start,
+                         server.bytes_received - received,
+                         server.bytes_sent - sent,
+                         1 + server.continuations - continuations)
     return proxy
 
 
+def command_name(name, args):
+    """Return the name of an IMAP command as recorded by instrumentation.
+
+    >>> command_name('select', ('INBOX',))
+    'SELECT'
+    >>> command_name('uid', ('sort', '(DATE)', 'UTF-8', 'ALL'))
+    'UID SORT'
+
+    """
+    name = name.upper()
+    if name == 'UID':
+        name = 'UID %s' % args[0].upper()
+    return name
+
+
+# Commands whose first argument is the mailbox they work on.
+MAILBOX_COMMANDS = frozenset([
+    'APPEND', 'CREATE', 'DELETE', 'EXAMINE', 'RENAME', 'SELECT', 'STATUS',
+    'SUBSCRIBE', 'UNSUBSCRIBE'])
+
+
+def command_mailbox(conn, command, args, selected_path=None):
+    """Return the mailbox a command works on, if any."""
+    if command in MAILBOX_COMMANDS:
+        return args[0]
+    if imaplib.Commands.get(command.split()[0]) == ('SELECTED',):
+        return selected_path or conn.selected_path
+
+
+class SpooledLiteral(object):
+    """A large literal string from a server response, kept in a file.
+
+    Spooled literals are passed through the parser unchanged and may be
+    read like a file.
+
+    """
+
+    def __init__(self, file, size):
+        self.file = file
+        self.size = size
+
+    def __repr__(self):
+        return '<SpooledLiteral of %s bytes>' % self.size
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def close(self):
+        self.file.close()
+
+
+def read_literal(self, size):
+    """Read `size` bytes from the server, spooling large literals to disk.
+
+    This replaces the `read` method of imaplib's connection classes which
+    is only used to read literals.
+
+    """
+    if not isinstance(self.file, DeflateReader):
+        self.bytes_received += size
+    if size < LITERAL_SPOOL_THRESHOLD:
+        return self.file.read(size)
+    spool = tempfile.SpooledTemporaryFile(max_size=LITERAL_SPOOL_THRESHOLD)
+    remaining = size
+    while remaining:
+        block = self.file.read(min(remaining, LITERAL_BLOCK_SIZE))
+        if not block:
+            spool.close()
+            raise self.abort('socket error: EOF')
+        spool.write(block)
+        remaining -= len(block)
+    spool.seek(0)
+    return SpooledLiteral(spool, size)
+
+
+class DeflateReader(object):
+    """Reads from a connection compressed with raw DEFLATE (RfC 4978).
+
+    Provides the part of the file API imaplib uses for reading responses.
+    `count` is called with the number of compressed bytes received.
+
+    """
+
+    def __init__(self, recv, data='', count=None):
+        self.recv = recv
+        self.count = count
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.buffer = self.decompressor.decompress(data)
+
+    def _fill(self):
+        data = self.recv(LITERAL_BLOCK_SIZE)
+        if not data:
+            return False
+        if self.count is not None:
+            self.count(len(data))
+        self.buffer += self.decompressor.decompress(data)
+        return True
+
+    def readline(self, size=-1):
+        start = 0
+        while True:
+            end = self.buffer.find('\n', start)
+            if end != -1 or 0 <= size <= len(self.buffer):
+                break
+            start = len(self.buffer)
+            if not self._fill():
+                break
+        if end == -1:
+            end = len(self.buffer)
+        else:
+            end += 1
+        if 0 <= size < end:
+            end = size
+        line, self.buffer = self.buffer[:end], self.buffer[end:]
+        return line
+
+    def read(self, size):
+        chunks = []
+        remaining = size
+        while remaining:
+            if not self.buffer and not self._fill():
+                break
+            chunk = self.buffer[:remaining]
+            self.buffer = self.buffer[remaining:]
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return ''.join(chunks)
+
+    def close(self):
+        pass
+
+
+def deflate(self, data):
+    self.bytes_sent_plain += len(data)
+    if self.compressor is not None:
+        data = (self.compressor.compress(data) +
+                self.compressor.flush(zlib.Z_SYNC_FLUSH))
+    # Count the bytes as they go over the wire.
+    self.bytes_sent += len(data)
+    return data
+
+
+def wire_size(server, size, since):
+    """Scale a number of bytes counted before compression to the bytes sent
+    on the wire, by the ratio of all bytes sent since the server's
+    (bytes_sent, bytes_sent_plain) were `since`.
+
+    """
+    plain = server.bytes_sent_plain - since[1]
+    if not plain:
+        return size
+    return size * (server.bytes_sent - since[0]) // plain
+
+
+def start_deflate(self):
+    """Compress everything sent and received from now on (RfC 4978)."""
+    if isinstance(self, imaplib.IMAP4_SSL):
+        recv = self.sslobj.read
+    else:
+        recv = self.sock.recv
+    # The file object may already have read beyond the COMPRESS completion.
+    pending = self.file._rbuf.getvalue()
+    self.bytes_received += len(pending)
+
+    def count(size):
+        self.bytes_received += size
+    self.file = DeflateReader(recv, pending, count)
+    self.compressor = zlib.compressobj(
+        zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+
+def readline(self):
+    line = self._readline()
+    if not isinstance(self.file, DeflateReader):
+        # Compressed data is counted as it is received.
+        self.bytes_received += len(line)
+    return line
+
+
+def get_response(self):
+    response = self._read_response()
+    if response is None:
+        self.continuations += 1
+    return response
+
+
+def capability(self):
+    """Don't ask for capabilities that are known already, either from the
+    server's greeting or from another connection to the same account.
+
+    """
+    if 'CAPABILITY' in self.untagged_responses:
+        return 'OK', self.untagged_responses.pop('CAPABILITY')
+    known = self.known_capabilities
+    if known is not None and known.known:
+        return 'OK', [' '.join(known)]
+    return imaplib.IMAP4.capability(self)
+
+
+def literal_size(message):
+    """Return the size of a message given as a string or file.
+
+    Files are sent from their current position to their end.
+
+    """
+    if isinstance(message, str):
+        return len(message)
+    size = getattr(message, 'size', None)
+    if size is not None:
+        return size
+    position = message.tell()
+    message.seek(0, 2)
+    size = message.tell() - position
+    message.seek(position)
+    return size
+
+
+def buffered(server):
+    """Tell whether response data can be read without waiting for the socket.
+    """
+    if isinstance(server.file, DeflateReader):
+        if server.file.buffer:
+            return True
+    elif server.file._rbuf.tell():
+        return True
+    sslobj = getattr(server, 'sslobj', None)
+    return sslobj is not None and sslobj.pending() > 0
+
+
+class IMAP4(imaplib.IMAP4):
+
+    read = read_literal
+    readline = readline
+    _readline = imaplib.IMAP4.readline
+    _get_response = get_response
+    _read_response = imaplib.IMAP4._get_response
+    capability = capability
+    bytes_received = 0
+    bytes_sent = 0
+    bytes_sent_plain = 0
+    continuations = 0
+    start_deflate = start_deflate
+    compressor = None
+
+    def __init__(self, host, port, known_capabilities=None):
+        self.known_capabilities = known_capabilities
+        imaplib.IMAP4.__init__(self, host, port)
+
+    def send(self, data):
+        imaplib.IMAP4.send(self, deflate(self, data))
+
+
+class IMAP4_SSL(imaplib.IMAP4_SSL):
+
+    read = read_literal
+    readline = readline
+    _readline = imaplib.IMAP4_SSL.readline
+    _get_response = get_response
+    _read_response = imaplib.IMAP4_SSL._get_response
+    capability = capability
+    bytes_received = 0
+    bytes_sent = 0
+    bytes_sent_plain = 0
+    continuations = 0
+    start_deflate = start_deflate
+    compressor = None
+
+    def __init__(self, host, port, known_capabilities=None):
+        self.known_capabilities = known_capabilities
+        imaplib.IMAP4_SSL.__init__(self, host, port)
+
+    def send(self, data):
+        imaplib.IMAP4_SSL.send(self, deflate(self, data))
+
+
+class Capabilities(object):
+    """The capabilities of a server, shared by all connections of an account.
+
+    Capabilities are learned when the first connection logs in. Operations
+    don't check for extensions themselves but ask which strategy to use:
+
+    >>> capabilities = Capabilities()
+    >>> capabilities.known
+    False
+    >>> capabilities.update(['IMAP4rev1', 'uidplus'])
+    >>> 'UIDPLUS' in capabilities
+    True
+    >>> capabilities.sort, capabilities.search
+    (None, 'SEARCH')
+    >>> capabilities.expunge, capabilities.move
+    ('UID EXPUNGE', 'COPY')
+    >>> capabilities.append
+    (1, -1)
+    >>> capabilities.status, capabilities.resync
+    ('STATUS', None)
+
+    >>> capabilities.update(['IMAP4rev1', 'SORT', 'ESORT', 'ESEARCH', 'MOVE',
+    ...                      'MULTIAPPEND', 'LITERAL-'])
+    >>> capabilities.sort, capabilities.search
+    ('ESORT', 'ESEARCH')
+    >>> capabilities.expunge, capabilities.move
+    ('EXPUNGE', 'MOVE')
+    >>> capabilities.append
+    (100, 4096)
+
+    >>> capabilities.update(['IMAP4rev1', 'LIST-STATUS', 'CONDSTORE'])
+    >>> capabilities.status, capabilities.resync
+    ('LIST-STATUS', 'CONDSTORE')
+    >>> capabilities.update(['IMAP4rev1', 'CONDSTORE', 'QRESYNC'])
+    >>> capabilities.resync
+    'QRESYNC'
+
+    """
+
+    names = None
+
+    def __init__(self, names=None):
+        if names is not None:
+            self.update(names)
+
+    @property
+    def known(self):
+        return self.names is not None
+
+    def update(self, names):
+        self.names = frozenset(name.upper() for name in names)
+
+    def __contains__(self, name):
+        return self.names is not None and name.upper() in self.names
+
+    def __iter__(self):
+        return iter(sorted(self.names or ()))
+
+    @property
+    def sort(self):
+        """SORT returning a compact sequence set (RfC 5267), plain SORT
+        (RfC 5256), or None if messages have to be sorted by the client.
+
+        """
+        if 'ESORT' in self:
+            return 'ESORT'
+        if 'SORT' in self:
+            return 'SORT'
+        return None
+
+    @property
+    def search(self):
+        """SEARCH returning a compact sequence set (RfC 4731) or plain
+        SEARCH.
+
+        """
+        if 'ESEARCH' in self:
+            return 'ESEARCH'
+        return 'SEARCH'
+
+    @property
+    def expunge(self):
+        """UID EXPUNGE which removes only the given messages (RfC 4315), or
+        EXPUNGE which removes all messages flagged as deleted.
+
+        """
+        if 'UIDPLUS' in self:
+            return 'UID EXPUNGE'
+        return 'EXPUNGE'
+
+    @property
+    def move(self):
+        """MOVE (RfC 6851), or COPY followed by deleting the originals."""
+        if 'MOVE' in self:
+            return 'MOVE'
+        return 'COPY'
+
+    @property
+    def append(self):
+        """The number of messages to send per APPEND (RfC 3502) and the size
+        up to which literals need not wait for the server's continuation
+        (RfC 7888), -1 meaning none.
+
+        """
+        batch_size = 1
+        if 'MULTIAPPEND' in self:
+            batch_size = MULTIAPPEND_BATCH_SIZE
+        if 'LITERAL+' in self:
+            non_synchronizing = sys.maxint
+        elif 'LITERAL-' in self:
+            non_synchronizing = LITERAL_MINUS_LIMIT
+        else:
+            non_synchronizing = -1
+        return batch_size, non_synchronizing
+
+    @property
+    def status(self):
+        """LIST returning the status of each mailbox (RfC 5819), or a STATUS
+        command per mailbox.
+
+        """
+        if 'LIST-STATUS' in self:
+            return 'LIST-STATUS'
+        return 'STATUS'
+
+    @property
+    def resync(self):
+        """Fetching changes since a MODSEQ along with the UIDs of removed
+        messages (QRESYNC), fetching changes only (CONDSTORE, both RfC 7162),
+        or None if everything has to be fetched.
+
+        """
+        if 'QRESYNC' in self:
+            return 'QRESYNC'
+        if 'CONDSTORE' in self:
+            return 'CONDSTORE'
+        return None
+
+
 class IMAPConnection(object):
     """A facade to the imaplib server connection which provides caching and
     exception handling.
@@ -33,11 +520,18 @@ class IMAPConnection(object):
 
     _selected_path = None
 
-    def __init__(self, host, port, ssl=False):
+    # Called with a CommandRecord for each command completed.
+    instrument = None
+
+    def __init__(self, host, port, ssl=False, capabilities=None):
+        if capabilities is None:
+            capabilities = Capabilities()
+        self.capabilities = capabilities
+        self.enabled = set()
         if ssl:
-            self.server = imaplib.IMAP4_SSL(host, port)
+            self.server = IMAP4_SSL(host, port, capabilities)
         else:
-            self.server = imaplib.IMAP4(host, port)
+            self.server = IMAP4(host, port, capabilities)
         logger.debug('connect(%s, %s)' % (host, port))
 
     def __getattr__(self, name):
@@ -52,9 +546,978 @@ class IMAPConnection(object):
             return None
         return self._selected_path
 
+    @property
+    def instrumented(self):
+        return (self.instrument is not None or
+                gocept.imapapi.instrumentation.profiling())
+
+    def _record(self, command, mailbox, status, seconds, size, sent,
+                round_trips):
+        record = gocept.imapapi.instrumentation.CommandRecord(
+            command, mailbox, seconds, size, status,
+            gocept.imapapi.instrumentation.current_operation(), sent,
+            round_trips)
+        if self.instrument is not None:
+            self.instrument(record)
+        gocept.imapapi.instrumentation.profile_record(record)
+
+    def login(self, user, password):
+        login = callable_proxy(self, 'login', self.server.login)
+        code, data = login(user, password)
+        # Servers may announce different capabilities after logging in.
+        match = CAPABILITY_CODE.search(data[0] or '')
+        if match is not None:
+            self.capabilities.update(match.group(1).split())
+        elif not self.capabilities.known:
+            # Ask once per account, other connections share the answer.
+            capability = callable_proxy(
+                self, 'capability', self.server.capability)
+            names = capability()[1][-1]
+            self.capabilities.update(names.split())
+        self.server.capabilities = tuple(self.capabilities)
+        return code, data
+
+    def compress(self):
+        """Compress the connection with DEFLATE if the server supports it.
+
+        Returns whether the connection is compressed.
+
+        """
+        server = self.server
+        if server.compressor is not None:
+            return True
+        if 'COMPRESS=DEFLATE' not in self.capabilities:
+            return False
+        compress = callable_proxy(self, 'compress', server._simple_command)
+        code, data = compress('COMPRESS', 'DEFLATE')
+        if code != 'OK':
+            return False
+        server.start_deflate()
+        return True
+
+    def enable(self, *names):
+        """Enable extensions on this connection (RfC 5161).
+
+        Extensions enabled before are not asked for again. ENABLE is only
+        valid before a folder has been selected, so this is meant to be
+        called right after logging in. Returns whether all extensions are
+        enabled.
+
+        """
+        missing = [name for name in names if name not in self.enabled]
+        if not missing:
+            return True
+        enable = callable_proxy(self, 'enable', self.server._simple_command)
+        try:
+            code, data = enable('ENABLE', *missing)
+        except imaplib.IMAP4.error:
+            # Servers reject ENABLE once a folder has been selected.
+            return False
+        # The server tells which of the extensions it has enabled.
+        enabled = self.server.untagged_responses.pop('ENABLED', [])
+        if code == 'OK':
+            for line in enabled:
+                self.enabled.update(
+                    name.upper() for name in (line or '').split())
+        return not [name for name in names if name not in self.enabled]
+
     def select(self, path):
         select = callable_proxy(self, 'select', self.server.select)
         code, data = select(path)
         if code == 'OK':
             self._selected_path = path
         return code, data
+
+    def idle(self, timeout):
+        """Wait for changes to the selected mailbox for `timeout` seconds.
+
+        Uses IDLE (RfC 2177) if the server supports it, or else a single NOOP
+        without waiting. Waiting ends early once the server has reported
+        something. Returns the untagged responses about the mailbox's
+        messages (see IDLE_EVENTS) as a list of (type, data) tuples in the
+        order they arrived. Other responses are kept as usual, so a BYE ends
+        waiting with an abort error.
+
+        """
+        self._finish_stream()
+        server = self.server
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s:%s: idle((%s,), {})' % (
+                server.host, server.port, timeout))
+        events = []
+        append_untagged = server._append_untagged
+
+        def capture(typ, dat):
+            if typ in IDLE_EVENTS:
+                events.append((typ, dat))
+            else:
+                append_untagged(typ, dat)
+        server._append_untagged = capture
+        try:
+            if 'IDLE' not in self.capabilities:
+                server._simple_command('NOOP')
+                return events
+            tag = server._command('IDLE')
+            while server._get_response():
+                if server.tagged_commands[tag] is not None:
+                    # IDLE was rejected.
+                    server._get_tagged_response(tag)
+                    return events
+            deadline = time.time() + timeout
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                if not buffered(server):
+                    readable = select.select([server.sock], [], [], remaining)
+                    if not readable[0]:
+                        break
+                server._get_response()
+                server._check_bye()
+                if events and not buffered(server):
+                    # Report what has arrived so far.
+                    break
+            server.send('DONE\r\n')
+            server._get_tagged_response(tag)
+        except (socket.error, OSError), e:
+            raise server.abort('socket error: %s' % e)
+        finally:
+            del server._append_untagged
+        return events
+
+    def closed_by_server(self):
+        """Tell whether the server has closed the connection while it wasn't
+        used, e.g. because of an autologout timer.
+
+        Nothing is sent: servers don't send anything unasked but BYE before
+        closing a connection, so anything to read means it is gone.
+
+        """
+        if self._stream is not None:
+            return False
+        server = self.server
+        if buffered(server):
+            return True
+        try:
+            readable = select.select([server.sock], [], [], 0)[0]
+        except (select.error, socket.error, ValueError):
+            return True
+        return bool(readable)
+
+    def list_status(self, pattern, items):
+        """List mailboxes along with their status (RfC 5819).
+
+        Returns the completion status, the LIST responses and the STATUS
+        responses.
+
+        """
+        server = self.server
+
+        def list_status(*args):
+            # Throw away unsolicited responses left over from earlier
+            # commands.
+            server.untagged_responses.pop('STATUS', None)
+            code, data = server._simple_command('LIST', *args)
+            code, data = server._untagged_response(code, data, 'LIST')
+            return code, data, server.untagged_responses.pop('STATUS', [])
+        list_status = callable_proxy(self, 'list', list_status)
+        return list_status(
+            '', pattern, 'RETURN', '(STATUS (%s))' % ' '.join(items))
+
+    def pipeline(self):
+        """Return a pipeline for sending several commands at once."""
+        return Pipeline(self)
+
+    def append_many(self, path, messages):
+        """Append messages to a mailbox using as few round trips as possible.
+
+        `messages` is an iterable of (flags, date_time, message) tuples with
+        `flags` and `date_time` as accepted by imaplib's `append`. Messages
+        may be strings or files which are read block-wise while sending
+        them; file contents are expected to use CRLF line endings already.
+
+        Servers supporting MULTIAPPEND (RfC 3502) get up to
+        MULTIAPPEND_BATCH_SIZE messages per command. Literals are
+        non-synchronizing if the server supports LITERAL+ or LITERAL-
+        (RfC 7888); otherwise each literal waits for the server's
+        continuation, but the next command is sent without waiting for the
+        previous one to complete.
+
+        Returns a list of (status, data, count) tuples, one for each APPEND
+        command sent, `count` being the number of messages it carried.
+
+        """
+        self._finish_stream()
+        server = self.server
+        batch_size, non_synchronizing = self.capabilities.append
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s:%s: append_many((%r,), {})' % (
+                server.host, server.port, path))
+
+        messages = iter(messages)
+        # Output is only written when waiting for the server, so commands
+        # and literals don't wait for each other in the socket layer.
+        output = []
+        pending = []
+        results = []
+        try:
+            while True:
+                # Getting the next messages may send commands over this
+                # connection, e.g. to fetch their source from another folder.
+                self._flush(output)
+                batch = list(itertools.islice(messages, batch_size))
+                if not batch:
+                    break
+                pending.append(
+                    self._append(path, batch, non_synchronizing, output))
+                if len(pending) >= APPEND_WINDOW:
+                    # Don't let unread completions pile up on the server.
+                    results.append(
+                        self._complete_append(pending.pop(0), output))
+            while pending:
+                results.append(self._complete_append(pending.pop(0), output))
+        except (socket.error, OSError), e:
+            raise server.abort('socket error: %s' % e)
+        server._check_bye()
+        return results
+
+    def _append(self, path, batch, non_synchronizing, output):
+        server = self.server
+        command = AppendCommand(path, len(batch))
+        command.start = time.time()
+        command.since = server.bytes_sent, server.bytes_sent_plain
+        continuations = server.continuations
+        command.tag = tag = server._new_tag()
+
+        def write(data):
+            output.append(data)
+            command.sent += len(data)
+
+        write('%s APPEND %s' % (tag, server._checkquote(path)))
+        for flags, date_time, message in batch:
+            if flags:
+                if (flags[0], flags[-1]) != ('(', ')'):
+                    flags = '(%s)' % flags
+                write(' ' + flags)
+            if date_time:
+                write(' ' + imaplib.Time2Internaldate(date_time))
+            if isinstance(message, basestring):
+                message = imaplib.MapCRLF.sub(imaplib.CRLF, str(message))
+            size = literal_size(message)
+            if size <= non_synchronizing:
+                write(' {%s+}\r\n' % size)
+            else:
+                write(' {%s}\r\n' % size)
+                self._flush(output)
+                while server._get_response():
+                    if server.tagged_commands[tag] is not None:
+                        # The server rejected the command.
+                        command.round_trips = (
+                            server.continuations - continuations)
+                        return command
+            if isinstance(message, str):
+                write(message)
+                if size >= LITERAL_BLOCK_SIZE:
+                    self._flush(output)
+                continue
+            self._flush(output)
+            command.sent += size
+            remaining = size
+            while remaining:
+                block = message.read(min(remaining, LITERAL_BLOCK_SIZE))
+                if not block:
+                    raise server.error('message ended before %s bytes were '
+                                       'read' % size)
+                server.send(block)
+                remaining -= len(block)
+        write(imaplib.CRLF)
+        command.round_trips = server.continuations - continuations
+        return command
+
+    def _flush(self, output):
+        data = ''.join(output)
+        del output[:]
+        if data:
+            self.server.send(data)
+
+    def _complete_append(self, command, output):
+        server = self.server
+        self._flush(output)
+        received = server.bytes_received
+        if (server.tagged_commands.get(command.tag) is None and
+            not buffered(server)):
+            # Waiting for the completion costs a round trip.
+            command.round_trips += 1
+        try:
+            code, data = server._get_tagged_response(command.tag)
+        except server.abort, e:
+            raise server.abort('command: APPEND => %s' % e)
+        if self.instrumented:
+            self._record('APPEND', command.path, code,
+                         time.time() - command.start,
+                         server.bytes_received - received,
+                         wire_size(server, command.sent, command.since),
+                         command.round_trips)
+        return code, data, command.count
+
+    def stream(self, untagged, name, *args):
+        """Send a command and yield its `untagged` responses as they arrive.
+
+        Instead of waiting for the tagged completion and returning all
+        responses at once as imaplib does, each response is read off the
+        socket, restored to a single line and yielded before the next one is
+        read. A BAD completion raises imaplib's error; any other completion
+        simply ends the iteration.
+
+        Any other command sent over this connection while the iteration is
+        still going on first reads the remaining responses into a buffer, so
+        commands can be nested inside the loop. If the consumer stops
+        iterating early, the remaining responses are read and discarded so
+        they cannot leak into later commands.
+
+        """
+        server = self.server
+        # Throw away unsolicited responses left over from earlier commands.
+        server.untagged_responses.pop(untagged, None)
+        command = callable_proxy(
+            self, name.lower(), lambda *args: server._command(name, *args),
+            record=False)
+        stream = Stream(name, untagged)
+        if self.instrumented:
+            stream.command = command_name(name, args)
+            stream.mailbox = command_mailbox(self, stream.command, args)
+            stream.start = time.time()
+            stream.received = server.bytes_received
+            stream.sent = server.bytes_sent
+        stream.tag = command(*args)
+        if stream.start is not None:
+            stream.sent = server.bytes_sent - stream.sent
+        self._stream = stream
+        try:
+            while True:
+                if self._stream is stream:
+                    server._check_bye()
+                    try:
+                        server._get_response()
+                    except server.abort, e:
+                        raise server.abort('command: %s => %s' % (name, e))
+                    stream.buffer.extend(
+                        server.untagged_responses.pop(untagged, ()))
+                    if server.tagged_commands[stream.tag] is not None:
+                        self._finish_stream()
+                if stream.buffer:
+                    items, stream.buffer = stream.buffer, []
+                    for line in gocept.imapapi.parser.unsplit(items):
+                        yield line
+                elif self._stream is not stream:
+                    break
+        except GeneratorExit:
+            if self._stream is stream:
+                self._finish_stream()
+            raise
+        code, data = stream.result
+        if code == 'BAD':
+            raise server.error('%s command error: %s %s' % (name, code, data))
+
+    _stream = None
+
+    def _finish_stream(self):
+        """Read the rest of a streamed command's responses into its buffer.
+        """
+        stream = self._stream
+        if stream is None:
+            return
+        self._stream = None
+        server = self.server
+        while server.tagged_commands[stream.tag] is None:
+            server._get_response()
+        stream.buffer.extend(server.untagged_responses.pop(stream.untagged, ()))
+        stream.result = server.tagged_commands.pop(stream.tag)
+        if stream.start is not None:
+            self._record(stream.command, stream.mailbox, stream.result[0],
+                         time.time() - stream.start,
+                         server.bytes_received - stream.received,
+                         stream.sent, 1)
+
+
+class ConnectionPool(object):
+    """Authenticated connections of an account, routed by mailbox.
+
+    Requests for a mailbox go to the connection that mailbox was last routed
+    to or that has it selected, so switching between folders doesn't keep
+    re-issuing SELECT. Other mailboxes get an unused connection, a new one as
+    long as the pool isn't full, or else the least recently used one.
+
+    """
+
+    def __init__(self, connect, size=1):
+        self.connect = connect
+        self.size = size
+        self.connections = []
+        self.affinity = {}
+        self.lock = threading.Lock()
+
+    def get(self, path=None):
+        """Return a connection to work on the mailbox `path`.
+
+        Without a path, any connection will do; the most recently used one is
+        returned.
+
+        """
+        self.lock.acquire()
+        try:
+            if path is None and self.connections:
+                return self.connections[-1]
+            connection = self.affinity.get(path)
+            if connection is None:
+                for candidate in self.connections:
+                    if candidate.selected_path == path:
+                        connection = candidate
+                        break
+            if connection is None:
+                assigned = self.affinity.values()
+                for candidate in self.connections:
+                    if (candidate not in assigned and
+                        candidate.selected_path is None):
+                        connection = candidate
+                        break
+            if connection is None:
+                if len(self.connections) < self.size:
+                    connection = self.connect()
+                else:
+                    connection = self.connections[0]
+            if connection in self.connections:
+                self.connections.remove(connection)
+            self.connections.append(connection)
+            if path is not None:
+                for key, value in self.affinity.items():
+                    if value is connection:
+                        del self.affinity[key]
+                self.affinity[path] = connection
+            return connection
+        finally:
+            self.lock.release()
+
+    def release(self):
+        """Connections are not bound to threads, so there is nothing to do.
+        """
+
+    def discard(self, connection):
+        """Forget a connection, closing its socket."""
+        self.lock.acquire()
+        try:
+            if connection in self.connections:
+                self.connections.remove(connection)
+            for key, value in self.affinity.items():
+                if value is connection:
+                    del self.affinity[key]
+        finally:
+            self.lock.release()
+        close_quietly(connection)
+
+    def discard_closed(self):
+        """Forget connections the server has closed, so they are replaced by
+        new ones as needed.
+
+        """
+        for connection in list(self.connections):
+            if connection.closed_by_server():
+                self.discard(connection)
+
+    def keepalive(self):
+        """Send NOOP over all connections, forgetting those that fail."""
+        for connection in list(self.connections):
+            try:
+                connection.noop()
+            except (imaplib.IMAP4.error, socket.error):
+                self.discard(connection)
+
+    def close(self):
+        """Log out all connections."""
+        for connection in list(self.connections):
+            try:
+                connection.logout()
+            except (imaplib.IMAP4.error, socket.error):
+                pass
+            self.discard(connection)
+
+
+class CheckoutPool(object):
+    """Connections of an account that may be used by several threads.
+
+    Each thread checks out a pool of connections when it first needs one and
+    keeps it until it releases it, so no two threads ever share a connection
+    or its selected mailbox. Released pools are handed to the next thread
+    instead of logging in again.
+
+    """
+
+    def __init__(self, connect, size=1):
+        self.connect = connect
+        self.size = size
+        self.idle = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def checkout(self):
+        """Return the pool of connections of the current thread."""
+        pool = getattr(self.local, 'pool', None)
+        if pool is None:
+            self.lock.acquire()
+            try:
+                if self.idle:
+                    pool = self.idle.pop()
+                else:
+                    pool = ConnectionPool(self.connect, self.size)
+            finally:
+                self.lock.release()
+            pool.discard_closed()
+            self.local.pool = pool
+        return pool
+
+    def get(self, path=None):
+        return self.checkout().get(path)
+
+    @property
+    def connections(self):
+        return self.checkout().connections
+
+    def release(self):
+        """Give the current thread's connections back for other threads."""
+        pool = getattr(self.local, 'pool', None)
+        if pool is None:
+            return
+        for connection in pool.connections:
+            connection._finish_stream()
+        del self.local.pool
+        pool.released = time.time()
+        self.lock.acquire()
+        try:
+            closed = self.closed
+            if not closed:
+                self.idle.append(pool)
+        finally:
+            self.lock.release()
+        if closed:
+            pool.close()
+
+    def _take_idle(self, seconds):
+        # Take pools released at least `seconds` ago out of circulation.
+        now = time.time()
+        self.lock.acquire()
+        try:
+            taken = [pool for pool in self.idle
+                     if now - pool.released >= seconds]
+            self.idle = [pool for pool in self.idle if pool not in taken]
+        finally:
+            self.lock.release()
+        return taken
+
+    def keepalive(self, seconds=0):
+        """Send NOOP over connections not used for `seconds`.
+
+        Connections checked out by a thread are left alone.
+
+        """
+        pools = self._take_idle(seconds)
+        for pool in pools:
+            pool.keepalive()
+            pool.released = time.time()
+        self.lock.acquire()
+        try:
+            closed = self.closed
+            if not closed:
+                self.idle.extend(pools)
+        finally:
+            self.lock.release()
+        if closed:
+            for pool in pools:
+                pool.close()
+
+    def close(self):
+        """Log out all connections.
+
+        Connections checked out by a thread are logged out when the thread
+        releases them.
+
+        """
+        self.lock.acquire()
+        try:
+            self.closed = True
+        finally:
+            self.lock.release()
+        for pool in self._take_idle(0):
+            pool.close()
+
+
+class WarmPool(object):
+    """Connections to a server that are opened before they are needed.
+
+    A daemon thread keeps up to `size` connections open that have been
+    through the TLS handshake, if any, and have read the server's greeting
+    and capabilities, so all that is left to a new session is to log in.
+
+    """
+
+    def __init__(self, host, port, ssl=False, size=2,
+                 max_age=WARM_CONNECTION_MAX_AGE):
+        self.host = host
+        self.port = port
+        self.ssl = ssl
+        self.size = size
+        self.max_age = max_age
+        self.ready = collections.deque()
+        self.lock = threading.Lock()
+        self.wanted = threading.Event()
+        self.stopped = False
+        self.hits = 0
+        self.misses = 0
+
+    def start(self):
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def run(self):
+        while not self.stopped:
+            self._expire()
+            if len(self.ready) >= self.size:
+                self.wanted.wait(self.max_age / 2.0)
+                self.wanted.clear()
+                continue
+            try:
+                connection = IMAPConnection(self.host, self.port, self.ssl)
+            except (socket.error, imaplib.IMAP4.error):
+                logger.debug('Could not open a connection to %s:%s' % (
+                    self.host, self.port), exc_info=True)
+                self.wanted.wait(self.max_age / 2.0)
+                self.wanted.clear()
+                continue
+            self.lock.acquire()
+            try:
+                # The pool may have been stopped while connecting.
+                stopped = self.stopped
+                if not stopped:
+                    self.ready.append((time.time(), connection))
+            finally:
+                self.lock.release()
+            if stopped:
+                close_quietly(connection)
+
+    def _expire(self):
+        now = time.time()
+        expired = []
+        self.lock.acquire()
+        try:
+            while self.ready and now - self.ready[0][0] >= self.max_age:
+                expired.append(self.ready.popleft()[1])
+        finally:
+            self.lock.release()
+        for connection in expired:
+            close_quietly(connection)
+
+    def get(self):
+        """Return a connection that is ready to log in, or None."""
+        self._expire()
+        connection = None
+        self.lock.acquire()
+        try:
+            while self.ready and connection is None:
+                connection = self.ready.popleft()[1]
+                if connection.closed_by_server():
+                    close_quietly(connection)
+                    connection = None
+            if connection is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        finally:
+            self.lock.release()
+        self.wanted.set()
+        return connection
+
+    def stop(self):
+        self.lock.acquire()
+        try:
+            self.stopped = True
+            ready, self.ready = self.ready, collections.deque()
+        finally:
+            self.lock.release()
+        self.wanted.set()
+        for opened, connection in ready:
+            close_quietly(connection)
+
+
+def close_quietly(connection):
+    try:
+        connection.server.shutdown()
+    except Exception:
+        pass
+
+
+# Warm pools by host, port and whether to use SSL.
+warm_pools = {}
+warm_pools_lock = threading.Lock()
+
+
+def warm_up(host, port, ssl=False, size=2,
+            max_age=WARM_CONNECTION_MAX_AGE):
+    """Keep connections to a server open ahead of time for new sessions.
+
+    Returns the server's warm pool. Calling this again for the same server
+    changes the pool's size and maximum age.
+
+    """
+    key = host, port, ssl
+    warm_pools_lock.acquire()
+    try:
+        pool = warm_pools.get(key)
+        if pool is None:
+            pool = warm_pools[key] = WarmPool(host, port, ssl, size, max_age)
+            pool.start()
+        else:
+            pool.size = size
+            pool.max_age = max_age
+            pool.wanted.set()
+    finally:
+        warm_pools_lock.release()
+    return pool
+
+
+def cool_down(host, port, ssl=False):
+    """Stop keeping connections to a server open ahead of time."""
+    warm_pools_lock.acquire()
+    try:
+        pool = warm_pools.pop((host, port, ssl), None)
+    finally:
+        warm_pools_lock.release()
+    if pool is not None:
+        pool.stop()
+
+
+def connect(host, port, ssl=False, capabilities=None):
+    """Return a new, unauthenticated connection to a server.
+
+    The connection is taken from the server's warm pool if there is one.
+
+    """
+    pool = warm_pools.get((host, port, ssl))
+    connection = None
+    if pool is not None:
+        connection = pool.get()
+    if connection is None:
+        return IMAPConnection(host, port, ssl, capabilities)
+    if capabilities is not None:
+        connection.capabilities = capabilities
+        connection.server.known_capabilities = capabilities
+    return connection
+
+
+class Pipeline(object):
+    """Commands that are sent at once and completed by tag afterwards.
+
+    Commands are queued until `execute` sends all of them without waiting
+    for any completion, so a sequence of commands costs roughly a single
+    round trip. The tagged completions are then read in order, each
+    command's untagged responses being those read before its completion.
+
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.commands = []
+        self.sent = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def command(self, untagged, name, *args, **kw):
+        """Queue a command whose result is its `untagged` responses.
+
+        A `callback` keyword argument is called with the command's status
+        and data once the whole pipeline has completed.
+
+        """
+        self.commands.append(
+            PipelinedCommand(untagged, name, args, kw.get('callback')))
+
+    def select(self, path, callback=None):
+        self.command('EXISTS', 'SELECT', path, callback=callback)
+
+    def status(self, path, names, callback=None):
+        self.command('STATUS', 'STATUS', path, names, callback=callback)
+
+    def list(self, directory='""', pattern='*', callback=None):
+        self.command('LIST', 'LIST', directory, pattern, callback=callback)
+
+    def uid(self, command, *args, **kw):
+        if args[:1] == ('RETURN',):
+            # Extended results (RfC 4731, RfC 5267).
+            untagged = 'ESEARCH'
+        elif command.upper() in ('SEARCH', 'SORT', 'THREAD', 'EXPUNGE'):
+            untagged = command.upper()
+        else:
+            untagged = 'FETCH'
+        self.command(untagged, 'UID', command, *args, **kw)
+
+    def execute(self):
+        """Send all queued commands, then read their completions.
+
+        Returns a list of (status, data) tuples in the order the commands
+        were queued. A BAD completion raises imaplib's error after all
+        completions have been read.
+
+        """
+        self.send()
+        return self.complete()
+
+    def send(self):
+        """Send all queued commands without reading any response."""
+        connection = self.connection
+        server = connection.server
+        connection._finish_stream()
+        commands, self.commands = self.commands, []
+        self.sent.extend(commands)
+
+        # Write all commands at once so they don't wait for each other in the
+        # socket layer.
+        buffer = []
+        server.send = buffer.append
+        try:
+            self._send(commands, buffer)
+        finally:
+            del server.send
+        since = server.bytes_sent, server.bytes_sent_plain
+        try:
+            server.send(''.join(buffer))
+        except (socket.error, OSError), e:
+            raise server.abort('socket error: %s' % e)
+        for command in commands:
+            command.sent = wire_size(server, command.sent, since)
+
+    def complete(self):
+        """Read the completions of the commands sent."""
+        connection = self.connection
+        server = connection.server
+        commands, self.sent = self.sent, []
+        error = None
+        results = []
+        for command in commands:
+            received = server.bytes_received
+            try:
+                code, data = server._get_tagged_response(command.tag)
+            except server.abort, e:
+                raise server.abort('command: %s => %s' % (command.name, e))
+            if connection.instrumented:
+                connection._record(
+                    command_name(command.name, command.args),
+                    command.mailbox, code, time.time() - command.start,
+                    server.bytes_received - received, command.sent,
+                    command.round_trips)
+            if command.name == 'SELECT':
+                if code == 'OK':
+                    connection._selected_path = command.args[0]
+                else:
+                    server.state = 'AUTH'
+            if code == 'BAD':
+                if error is None:
+                    error = '%s command error: %s %s' % (
+                        command.name, code, data)
+            elif code != 'NO':
+                data = server.untagged_responses.pop(
+                    command.untagged, [None])
+            results.append((code, data))
+        server._check_bye()
+        if error is not None:
+            raise server.error(error)
+
+        for command, result in zip(commands, results):
+            if command.callback is not None:
+                command.callback(*result)
+        return results
+
+    def _send(self, commands, buffer):
+        connection = self.connection
+        server = connection.server
+        selected_path = connection.selected_path
+        for command in commands:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('%s:%s: %s(%s, %s)' % (
+                    server.host, server.port, command.name.lower(),
+                    command.args, {}))
+            command.mailbox = command_mailbox(
+                connection, command_name(command.name, command.args),
+                command.args, selected_path)
+            command.start = time.time()
+            # All commands sent at once wait for a single round trip.
+            command.round_trips = int(command is commands[0])
+            if command.name == 'SELECT':
+                selected_path = command.args[0]
+                # Flush old responses as imaplib's select does.
+                server.untagged_responses = {}
+                server.is_readonly = False
+                connection._selected_path = None
+            offset = len(buffer)
+            command.tag = server._command(command.name, *command.args)
+            command.sent = sum(len(data) for data in buffer[offset:])
+            if command.name == 'SELECT':
+                # Later commands in the pipeline run on the selected mailbox.
+                server.state = 'SELECTED'
+
+
+class AppendCommand(object):
+    """An APPEND command sent by `IMAPConnection.append_many`."""
+
+    tag = None
+    start = None
+    since = None
+    sent = 0
+    round_trips = 0
+
+    def __init__(self, path, count):
+        self.path = path
+        self.count = count
+
+
+class PipelinedCommand(object):
+    """A command queued in a pipeline."""
+
+    tag = None
+    mailbox = None
+    start = None
+    sent = 0
+    round_trips = 0
+
+    def __init__(self, untagged, name, args, callback):
+        self.untagged = untagged
+        self.name = name
+        self.args = args
+        self.callback = callback
+
+
+def execute(pipelines):
+    """Execute pipelines on several connections concurrently.
+
+    All pipelines are sent before any completion is read, so the servers
+    work on them at the same time and the whole batch costs roughly one
+    round trip to the slowest server. Returns the results of each pipeline.
+
+    """
+    for pipeline in pipelines:
+        pipeline.send()
+    return [pipeline.complete() for pipeline in pipelines]
+
+
+class Stream(object):
+    """State of a command whose responses are being streamed."""
+
+    tag = None
+    result = None
+    start = None
+
+    def __init__(self, name, untagged):
+        self.name = name
+        self.untagged = untagged
+        self.buffer = []
@@ -0,0 +1,418 @@
+# Copyright (c) 2011 gocept gmbh & co. kg
+# See also LICENSE.txt
+"""Record which IMAP commands are sent, how long they take and why."""
+
+import bisect
+import collections
+import threading
+import time
+import types
+
+# Upper bounds of histogram buckets for command latency in seconds and
+# response size in bytes. Larger values go to a last, unbounded bucket.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = tuple(64 << (2 * i) for i in xrange(11))
+
+
+class CommandRecord(object):
+    """What is known about a completed command.
+
+    `command` is the IMAP command's name, including the command sent by UID.
+    `mailbox` is the encoded path of the mailbox it worked on, if any.
+    `seconds` is the time from sending the command to reading its
+    completion, `size` the number of bytes of its responses and `status`
+    its completion status or ERROR if it raised an exception. `operation` is
+    the API call the command was sent for, if known. `sent` is the number of
+    bytes of the command itself and `round_trips` the number of times the
+    client had to wait for the server: commands sent along with others in a
+    pipeline don't cost a round trip of their own, while literals sent after
+    a continuation cost an additional one.
+
+    """
+
+    __slots__ = ('command', 'mailbox', 'seconds', 'size', 'status',
+                 'operation', 'sent', 'round_trips')
+
+    def __init__(self, command, mailbox, seconds, size, status,
+                 operation=None, sent=0, round_trips=1):
+        self.command = command
+        self.mailbox = mailbox
+        self.seconds = seconds
+        self.size = size
+        self.status = status
+        self.operation = operation
+        self.sent = sent
+        self.round_trips = round_trips
+
+    def __repr__(self):
+        return '<CommandRecord %s %s %r %s bytes (%s)>' % (
+            self.command, self.status, self.mailbox, self.size,
+            self.operation)
+
+
+_operations = threading.local()
+
+
+def current_operation():
+    """Return the name of the outermost API call being executed, if any.
+
+    >>> print current_operation()
+    None
+
+    """
+    stack = getattr(_operations, 'stack', None)
+    if stack:
+        return stack[0]
+
+
+def _push(name):
+    stack = getattr(_operations, 'stack', None)
+    if stack is None:
+        stack = _operations.stack = []
+    stack.append(name)
+
+
+def _pop():
+    _operations.stack.pop()
+
+
+def operation(name):
+    """Decorate a method to attribute the commands it causes to `name`.
+
+    Commands are attributed to the outermost decorated call, which is the
+    call made by the application. For generators, each step of the
+    iteration is attributed to the call that created the generator.
+
+    >>> @operation('Example.count')
+    ... def count(n):
+    ...     for i in xrange(n):
+    ...         yield current_operation()
+    >>> list(count(2))
+    ['Example.count', 'Example.count']
+    >>> print current_operation()
+    None
+
+    """
+    def decorate(method):
+        def wrapped(*args, **kw):
+            _push(name)
+            try:
+                result = method(*args, **kw)
+            finally:
+                _pop()
+            if isinstance(result, types.GeneratorType):
+                result = _iterate(name, result)
+            return result
+        wrapped.__name__ = method.__name__
+        wrapped.__doc__ = method.__doc__
+        return wrapped
+    return decorate
+
+
+def _iterate(name, generator):
+    try:
+        while True:
+            _push(name)
+            try:
+                item = generator.next()
+            except StopIteration:
+                return
+            finally:
+                _pop()
+            yield item
+    finally:
+        # Closing the generator may still read responses from the server.
+        _push(name)
+        try:
+            generator.close()
+        finally:
+            _pop()
+
+
+class Histogram(object):
+    """Counts values in buckets with fixed upper bounds.
+
+    >>> histogram = Histogram((1, 10, 100))
+    >>> for value in [0.5, 1, 7, 8, 50, 1000]:
+    ...     histogram.add(value)
+    >>> histogram.counts
+    [2, 2, 1, 1]
+    >>> histogram.count, histogram.sum, histogram.max
+    (6, 1066.5, 1000)
+
+    Quantiles are estimated as the upper bound of the bucket they fall in:
+
+    >>> histogram.quantile(0.5)
+    10
+    >>> histogram.quantile(1)
+    1000
+
+    """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return self.max
+
+    def snapshot(self):
+        return dict(bounds=list(self.bounds), counts=list(self.counts),
+                    count=self.count, sum=self.sum, max=self.max)
+
+
+class Metrics(object):
+    """Counters and histograms of the commands sent for an account.
+
+    Commands are counted by name and status. Latency is kept by command,
+    by mailbox and by API call, response sizes by command.
+
+    >>> metrics = Metrics()
+    >>> metrics.record(CommandRecord('SELECT', 'INBOX', 0.002, 300, 'OK',
+    ...                              'Messages.filtered'))
+    >>> metrics.record(CommandRecord('UID SORT', 'INBOX', 0.03, 60, 'OK',
+    ...                              'Messages.filtered'))
+    >>> metrics.record(CommandRecord('STATUS', 'Bar', 0.004, 40, 'OK',
+    ...                              'Folder.message_count'))
+    >>> sorted(metrics.counts.items())
+    [(('SELECT', 'OK'), 1), (('STATUS', 'OK'), 1), (('UID SORT', 'OK'), 1)]
+    >>> metrics.server_time()
+    [('Messages.filtered', 0.032, 2), ('Folder.message_count', 0.004, 1)]
+    >>> metrics.sizes['SELECT'].sum
+    300
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counts = collections.defaultdict(int)
+        self.latency = {}
+        self.sizes = {}
+        self.mailboxes = {}
+        self.operations = {}
+
+    def record(self, record):
+        self.lock.acquire()
+        try:
+            self.counts[record.command, record.status] += 1
+            self._add(self.latency, record.command, LATENCY_BUCKETS,
+                      record.seconds)
+            self._add(self.sizes, record.command, SIZE_BUCKETS, record.size)
+            self._add(self.mailboxes, record.mailbox, LATENCY_BUCKETS,
+                      record.seconds)
+            self._add(self.operations, record.operation, LATENCY_BUCKETS,
+                      record.seconds)
+        finally:
+            self.lock.release()
+
+    def _add(self, histograms, key, bounds, value):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram(bounds)
+        histogram.add(value)
+
+    def server_time(self):
+        """Return the API calls that took the most time on the server first.
+
+        Each item is a tuple of the call's name, the total seconds spent
+        waiting for the server and the number of commands sent.
+
+        """
+        result = [(name, histogram.sum, histogram.count)
+                  for name, histogram in self.operations.items()]
+        result.sort(key=lambda item: item[1], reverse=True)
+        return result
+
+    def snapshot(self):
+        """Return the current state as plain data for exporting it."""
+        self.lock.acquire()
+        try:
+            return dict(
+                counts=[dict(command=command, status=status, count=count)
+                        for (command, status), count in self.counts.items()],
+                latency=self._snapshot(self.latency),
+                sizes=self._snapshot(self.sizes),
+                mailboxes=self._snapshot(self.mailboxes),
+                operations=self._snapshot(self.operations))
+        finally:
+            self.lock.release()
+
+    def _snapshot(self, histograms):
+        return dict((key, histogram.snapshot())
+                    for key, histogram in histograms.items())
+
+
+_profiles = threading.local()
+
+
+def profiling():
+    """Tell whether a profile is active in the current thread."""
+    return bool(getattr(_profiles, 'active', None))
+
+
+def profile_record(record):
+    """Pass a record to the profiles active in the current thread."""
+    for active in getattr(_profiles, 'active', ()):
+        active.records.append(record)
+
+
+class Summary(object):
+    """Totals of a group of command records."""
+
+    def __init__(self, records):
+        self.commands = [record.command for record in records]
+        self.round_trips = sum(record.round_trips for record in records)
+        self.bytes = sum(record.size + record.sent for record in records)
+        self.seconds = sum(record.seconds for record in records)
+
+    def __repr__(self):
+        return '<Summary of %s commands, %s round trips, %s bytes>' % (
+            len(self.commands), self.round_trips, self.bytes)
+
+
+class Profile(object):
+    """Records the commands sent by the current thread within a block.
+
+    >>> with Profile() as profile:
+    ...     for record in [
+    ...             CommandRecord('SELECT', 'INBOX', 0.002, 300, 'OK',
+    ...                           'Messages.filtered', 21, 1),
+    ...             CommandRecord('UID SORT', 'INBOX', 0.03, 60, 'OK',
+    ...                           'Messages.filtered', 88, 0),
+    ...             CommandRecord('STATUS', 'Bar', 0.004, 40, 'OK',
+    ...                           'Folder.message_count', 35, 1)]:
+    ...         profile_record(record)
+    >>> profile.commands
+    ['SELECT', 'UID SORT', 'STATUS']
+    >>> profile.round_trips, profile.bytes
+    (2, 544)
+
+    The commands are grouped by the API call they were sent for:
+
+    >>> groups = profile.by_operation()
+    >>> groups['Messages.filtered']
+    <Summary of 2 commands, 1 round trips, 469 bytes>
+    >>> print profile.report()
+    Messages.filtered                2 commands   1 round trips       469 bytes
+      SELECT 'INBOX' OK
+      UID SORT 'INBOX' OK
+    Folder.message_count             1 commands   1 round trips        75 bytes
+      STATUS 'Bar' OK
+
+    Tests may assert a budget of commands or round trips. Failures show the
+    report:
+
+    >>> profile.assert_round_trips(2)
+    >>> profile.assert_commands(0, 'LIST')
+    >>> profile.assert_round_trips(0, 'Folder.message_count')
+    Traceback (most recent call last):
+    AssertionError: 1 round trips for Folder.message_count, expected at
+    most 0:
+    Messages.filtered ...
+
+    """
+
+    seconds = None
+
+    def __init__(self):
+        self.records = []
+
+    def __enter__(self):
+        active = getattr(_profiles, 'active', None)
+        if active is None:
+            active = _profiles.active = []
+        active.append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.time() - self.start
+        _profiles.active.remove(self)
+
+    def _select(self, operation=None, command=None):
+        return [record for record in self.records
+                if (operation is None or record.operation == operation)
+                and (command is None or record.command == command)]
+
+    @property
+    def commands(self):
+        return [record.command for record in self.records]
+
+    @property
+    def round_trips(self):
+        return Summary(self.records).round_trips
+
+    @property
+    def bytes(self):
+        return Summary(self.records).bytes
+
+    @property
+    def server_seconds(self):
+        """The time spent waiting for the server."""
+        return Summary(self.records).seconds
+
+    def by_operation(self):
+        """Return a summary of the commands sent for each API call."""
+        groups = collections.OrderedDict()
+        for record in self.records:
+            groups.setdefault(record.operation, []).append(record)
+        return collections.OrderedDict(
+            (operation, Summary(records))
+            for operation, records in groups.items())
+
+    def report(self):
+        """Describe the commands sent for each API call."""
+        lines = []
+        for operation, summary in self.by_operation().items():
+            lines.append('%-28s %5s commands %3s round trips %9s bytes' % (
+                operation, len(summary.commands), summary.round_trips,
+                summary.bytes))
+            for record in self._select(operation):
+                lines.append('  %s %r %s' % (
+                    record.command, record.mailbox, record.status))
+        return '\n'.join(lines)
+
+    def assert_round_trips(self, maximum, operation=None):
+        """Fail if more than `maximum` round trips were needed, optionally
+        only counting those of a given API call.
+
+        """
+        count = Summary(self._select(operation)).round_trips
+        self._check(count, maximum, 'round trips', operation)
+
+    def assert_commands(self, maximum, command=None, operation=None):
+        """Fail if more than `maximum` commands were sent, optionally only
+        counting those of a given name or API call.
+
+        """
+        count = len(self._select(operation, command))
+        self._check(count, maximum, command or 'commands', operation)
+
+    def _check(self, count, maximum, what, operation):
+        if count <= maximum:
+            return
+        if operation is not None:
+            what += ' for %s' % operation
+        raise AssertionError('%s %s, expected at most %s:\n%s' % (
+            count, what, maximum, self.report()))
+
@@ -76,6 +76,22 @@ class IMessages(zope.interface.common.mapping.IMapping):
     def add(message):
         """Add a message to the container."""
 
+    def add_many(messages):
+        """Add messages to the container using as few round trips as
+        possible.
+
+        Returns a list of the new messages' keys.
+
+        """
+
+    def move(keys, target):
+        """Move the messages with the given keys to another folder of the
+        same account."""
+
+    def batch():
+        """Return UIDs, sizes, flags and envelopes of all messages as a
+        MessageBatch."""
+
     def filtered(sort_by=None, sort_dir='asc',
                  filter_by=None, filter_value=None):
         """Return a sequence of all messages that pass the filter."""
@@ -108,6 +124,20 @@ class IAccount(IFolderContainer):
 
     """
 
+    def release():
+        """Give back the connections the current thread has been using."""
+
+    def watch(folder):
+        """Keep the message count and flags of a folder current using IDLE.
+
+        Returns the watcher.
+
+        """
+
+    def folder_counts():
+        """Return all folders by path, having fetched their counts at once.
+        """
+
 
 class IFolder(IFolderContainer, IMessageContainer, IAccountContent):
     """An IMAP folder.
@@ -127,6 +157,17 @@ class IFolder(IFolderContainer, IMessageContainer, IAccountContent):
 
     path = zope.schema.TextLine(title=u'Folder path')
 
+    def status(items=None):
+        """Return the numbers of messages and unread messages, UIDNEXT and
+        UIDVALIDITY of the folder, or those of them given as `items`."""
+
+    def changes_since(state=None):
+        """Return what changed in the folder since a synchronization state.
+        """
+
+    def move(target, progress=None):
+        """Move the folder into another folder or account."""
+
 
 class IBodyPart(zope.interface.Interface):
     """A part of a message body.
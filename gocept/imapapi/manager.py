@@ -0,0 +1,219 @@
+# Copyright (c) 2011 gocept gmbh & co. kg
+# See also LICENSE.txt
+"""Keep the logged-in accounts of many users for reuse."""
+
+import collections
+import gocept.imapapi
+import gocept.imapapi.account
+import gocept.imapapi.imap
+import logging
+import threading
+import time
+
+logger = logging.getLogger('gocept.imapapi.manager')
+
+
+class AccountManager(object):
+    """A bounded, least recently used set of logged-in accounts.
+
+    Accounts are kept by server and user and handed out again as long as
+    they are asked for with the same password, so handling a request doesn't
+    have to connect and log in each time. Accounts are thread-safe, so each
+    thread handling a request must release the account's connections when it
+    is done.
+
+    The password may have been changed on the server meanwhile. If
+    `verify_interval` is given, it is checked by logging in again when an
+    account is asked for more than that many seconds after the last check,
+    and an account whose password doesn't work anymore is logged out. Each
+    check costs a connection of its own and a complete login and logout,
+    i.e. several round trips and the server's password check, on the
+    request that happens to trigger it, so checks are off by default and
+    should be spaced by minutes rather than seconds.
+
+    Accounts that have not been asked for during `idle_timeout` seconds are
+    logged out, as is the least recently used account once there are more
+    than `size` of them. `maintain` keeps the others from being logged out by
+    the server: it sends NOOP over connections not used for `keepalive`
+    seconds. Connections the server has closed anyway are replaced when the
+    account is next used. `start` maintains the accounts in a thread until
+    `stop` or `clear` is called.
+
+    """
+
+    def __init__(self, size=1000, idle_timeout=1800, keepalive=600,
+                 verify_interval=None, factory=gocept.imapapi.account.Account,
+                 **options):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.verify_interval = verify_interval
+        self.factory = factory
+        self.options = options
+        self.accounts = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def get(self, host, port, user, password, ssl=False):
+        """Return a logged-in account, reusing one if possible."""
+        key = host, port, user, ssl
+        now = time.time()
+        self.lock.acquire()
+        try:
+            evicted = self._evict_idle(now)
+            entry = self.accounts.get(key)
+            if entry is not None and entry.account.password == password:
+                self.hits += 1
+                entry.used = now
+                del self.accounts[key]
+                self.accounts[key] = entry
+                account = entry.account
+            else:
+                self.misses += 1
+                account = None
+        finally:
+            self.lock.release()
+        for entry in evicted:
+            entry.close()
+        if account is not None:
+            if (self.verify_interval is not None and
+                now - entry.verified >= self.verify_interval):
+                self._verify(key, entry)
+                entry.verified = now
+            return account
+
+        # A different password is checked by logging in. If that works, the
+        # new account replaces the one kept so far.
+        account = self.factory(host, port, user, password, ssl=ssl,
+                               threadsafe=True, **self.options)
+        evicted = []
+        self.lock.acquire()
+        try:
+            previous = self.accounts.pop(key, None)
+            if previous is not None:
+                evicted.append(previous)
+            self.accounts[key] = ManagedAccount(account, now)
+            while len(self.accounts) > self.size:
+                evicted.append(self.accounts.popitem(last=False)[1])
+                self.evictions += 1
+        finally:
+            self.lock.release()
+        for entry in evicted:
+            entry.close()
+        return account
+
+    def _verify(self, key, entry):
+        try:
+            connection = entry.account.connect()
+        except gocept.imapapi.IMAPConnectionError:
+            self.lock.acquire()
+            try:
+                if self.accounts.get(key) is entry:
+                    del self.accounts[key]
+                    self.evictions += 1
+            finally:
+                self.lock.release()
+            entry.close()
+            raise
+        try:
+            connection.logout()
+        except Exception:
+            gocept.imapapi.imap.close_quietly(connection)
+
+    def _evict_idle(self, now):
+        # Called with the lock held, so the accounts are closed later.
+        evicted = []
+        while self.accounts:
+            # The least recently used account comes first.
+            key, entry = next(self.accounts.iteritems())
+            if now - entry.used < self.idle_timeout:
+                break
+            del self.accounts[key]
+            self.evictions += 1
+            evicted.append(entry)
+        return evicted
+
+    def maintain(self):
+        """Log out idle accounts and keep the connections of the others
+        alive.
+
+        This is meant to be called periodically, see `start`.
+
+        """
+        now = time.time()
+        self.lock.acquire()
+        try:
+            evicted = self._evict_idle(now)
+            entries = self.accounts.values()
+        finally:
+            self.lock.release()
+        for entry in evicted:
+            entry.close()
+        for entry in entries:
+            entry.account.pool.keepalive(self.keepalive)
+
+    def start(self, interval=60):
+        """Call `maintain` every `interval` seconds in a daemon thread until
+        `stop` is called.
+
+        """
+        self.lock.acquire()
+        try:
+            if self.thread is not None and self.thread.is_alive():
+                return self.thread
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self._run, args=(interval,))
+            self.thread.daemon = True
+            self.thread.start()
+            return self.thread
+        finally:
+            self.lock.release()
+
+    def _run(self, interval):
+        while not self.stopped.wait(interval):
+            try:
+                self.maintain()
+            except Exception:
+                logger.exception('Error maintaining accounts')
+
+    def stop(self):
+        """Stop the maintenance thread and wait for it to end."""
+        self.stopped.set()
+        thread, self.thread = self.thread, None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def clear(self):
+        """Stop maintenance and log out all accounts."""
+        self.stop()
+        self.lock.acquire()
+        try:
+            entries = self.accounts.values()
+            self.accounts.clear()
+        finally:
+            self.lock.release()
+        for entry in entries:
+            entry.close()
+
+    def stats(self):
+        return dict(accounts=len(self.accounts), hits=self.hits,
+                    misses=self.misses, evictions=self.evictions)
+
+
+class ManagedAccount(object):
+
+    def __init__(self, account, used):
+        self.account = account
+        self.used = used
+        self.verified = used
+
+    def close(self):
+        try:
+            self.account.pool.close()
+        except Exception:
+            logger.debug('Error logging out %s' % self.account.user,
+                         exc_info=True)
@@ -3,15 +3,20 @@
 
 import cStringIO
 import UserDict
+import array
 import base64
 import email.Header
 import email.Message
 import email.Parser
+import gocept.imapapi.imap
+import gocept.imapapi.instrumentation
 import gocept.imapapi.interfaces
 import gocept.imapapi.parser
 import imaplib
 import itertools
 import quopri
+import re
+import shutil
 import tempfile
 import time
 import zope.interface
@@ -19,6 +24,17 @@ import zope.interface
 parser = email.Parser.Parser()
 
 
+def decode_header(value):
+    """Decode an RfC 2047 encoded header value to unicode."""
+    if value is None:
+        return u''
+    result = u''
+    decoded = email.Header.decode_header(value)
+    for text, charset in decoded:
+        result += fallback_decode(text, charset)
+    return result
+
+
 class MessageHeaders(UserDict.DictMixin):
     """A dictionary that performs RfC 2822 header decoding on access."""
 
@@ -34,18 +50,13 @@ class MessageHeaders(UserDict.DictMixin):
         except KeyError:
             self.fetch_headers()
             value = self.headers[key]
-        if value is None:
-            return u''
-        result = u''
-        decoded = email.Header.decode_header(value)
-        for text, charset in decoded:
-            result += fallback_decode(text, charset)
-        return result
+        return decode_header(value)
 
     def keys(self):
         self.fetch_headers()
         return self.headers.keys()
 
+    @gocept.imapapi.instrumentation.operation('Message.headers')
     def fetch_headers(self):
         if self.headers is not None:
             return
@@ -102,6 +113,7 @@ class BodyPart(object):
 
     zope.interface.implements(gocept.imapapi.interfaces.IBodyPart)
 
+    @gocept.imapapi.instrumentation.operation('BodyPart.__init__')
     def __init__(self, data, parent, part_number):
         self._data = data
         self._parent = parent
@@ -157,6 +169,7 @@ class BodyPart(object):
         for part in self.find_all(content_type):
             return part
 
+    @gocept.imapapi.instrumentation.operation('BodyPart.fetch')
     def fetch(self):
         """Fetch the body part's content.
 
@@ -168,6 +181,7 @@ class BodyPart(object):
         self.fetch_file(temp)
         return temp.getvalue()
 
+    @gocept.imapapi.instrumentation.operation('BodyPart.fetch_file')
     def fetch_file(self, f):
         """Fetch the body part into a file-like object."""
         # XXX This is icky. This means that on multipart messages we will
@@ -185,8 +199,8 @@ class BodyPart(object):
 
         encoding = self.get('encoding')
         if encoding in ['base64', 'quoted-printable']:
-            # XXX Make StringIO first, swap to temporary file on a size threshold.
-            encoded = tempfile.NamedTemporaryFile()
+            encoded = tempfile.SpooledTemporaryFile(
+                max_size=gocept.imapapi.imap.LITERAL_SPOOL_THRESHOLD)
         else:
             encoded = f
 
@@ -197,7 +211,14 @@ class BodyPart(object):
                 break
             if data == gocept.imapapi.parser.NIL:
                 raise gocept.imapapi.interfaces.BrokenMIMEPart()
-            encoded.write(data)
+            if isinstance(data, str):
+                encoded.write(data)
+            else:
+                # Large chunks have been spooled to a file while reading the
+                # response, copy them over without loading them into memory.
+                shutil.copyfileobj(
+                    data, encoded, gocept.imapapi.imap.LITERAL_BLOCK_SIZE)
+                data.close()
 
         encoded.seek(0)
         if encoding == 'base64':
@@ -268,11 +289,13 @@ class MessagePart(object):
         self.parent = body
 
     @property
+    @gocept.imapapi.instrumentation.operation('MessagePart.text')
     def text(self):
         return _fetch(self.body.server, self.body.message.parent, self.UID,
                       'BODY[%s.TEXT]' % self.body['partnumber'])
 
     @property
+    @gocept.imapapi.instrumentation.operation('MessagePart.raw')
     def raw(self):
         return _fetch(self.body.server, self.body.message.parent, self.UID,
                       'BODY.PEEK[%s]' % self.body['partnumber'])
@@ -305,15 +328,18 @@ class Message(object):
         return self.name.split('-')[1]
 
     @property
+    @gocept.imapapi.instrumentation.operation('Message.text')
     def text(self):
         return _fetch(self.server, self.parent, self.UID, 'BODY[TEXT]')
 
     @property
+    @gocept.imapapi.instrumentation.operation('Message.raw')
     def raw(self):
         return _fetch(self.server, self.parent, self.UID, 'BODY.PEEK[]')
 
     __bodystructure = None
     @property
+    @gocept.imapapi.instrumentation.operation('Message.body')
     def _bodystructure(self):
         if self.__bodystructure is None:
             # We may safely cache the body structure as RfC 3501 asserts that
@@ -333,6 +359,43 @@ class Message(object):
         return self.body.estimated_attachments
 
 
+def address_sort_key(value):
+    """Sort by the address of the first mailbox, like SORT's FROM, TO and CC.
+    """
+    return email.Utils.parseaddr(value)[1].lower()
+
+
+SUBJECT_PREFIX = re.compile(
+    r'^(\s*((re|fwd?)\s*(\[[^\]]*\])?\s*:|\[[^\]]*\]))+', re.IGNORECASE)
+
+
+def subject_sort_key(value):
+    """Sort by an approximation of the base subject (RfC 5256).
+
+    >>> subject_sort_key('Re: Fwd: [list] Re:  Hello World')
+    u'hello world'
+
+    """
+    return SUBJECT_PREFIX.sub('', decode_header(value)).strip().lower()
+
+
+def date_sort_key(value):
+    date = email.Utils.parsedate_tz(value)
+    if date is None:
+        return 0
+    return email.Utils.mktime_tz(date)
+
+
+# Header and sort key for sort criteria if the server doesn't support SORT.
+CLIENT_SORT_KEYS = {
+    'CC': ('CC', address_sort_key),
+    'DATE': ('DATE', date_sort_key),
+    'FROM': ('FROM', address_sort_key),
+    'SUBJECT': ('SUBJECT', subject_sort_key),
+    'TO': ('TO', address_sort_key),
+}
+
+
 class Messages(UserDict.DictMixin):
     """A mapping object for accessing messages located in IMessageContainers.
     """
@@ -352,17 +415,25 @@ class Messages(UserDict.DictMixin):
         return '%s-%s' % (self.container.uidvalidity, uid)
 
     def _fetch_lines(self, msg_set, spec, uid=False):
+        """Yield FETCH response lines as they are read from the server."""
+        # Computing message keys needs the UID validity. Look it up before
+        # starting the FETCH so the STATUS command doesn't end the stream.
+        self.container.uidvalidity
         self.container._select()
+        if uid:
+            command = ('UID', 'FETCH', msg_set, spec)
+        else:
+            command = ('FETCH', msg_set, spec)
         try:
-            code, data = self.container.server.fetch(msg_set, spec)
+            for line in self.container.server.stream('FETCH', *command):
+                yield line
         except imaplib.IMAP4.error:
             # Messages might have been deleted (Dovecot).
-            return []
-        if code == 'NO':
-            # Messages might have been deleted (Cyrus).
-            return []
-        return gocept.imapapi.parser.unsplit(data)
+            return
+        # A NO response simply doesn't yield anything. Messages might have
+        # been deleted (Cyrus).
 
+    @gocept.imapapi.instrumentation.operation('Messages.keys')
     def keys(self):
         lines = self._fetch_lines('%s:%s' % (1, len(self)), '(UID)')
         uids = (gocept.imapapi.parser.fetch(line)['UID'] for line in lines)
@@ -375,31 +446,52 @@ class Messages(UserDict.DictMixin):
         import pprint
         __traceback_info__ = pprint.pformat(data)
 
+        flags = data['FLAGS']
+        watcher = self.container.watcher
+        if watcher is not None:
+            flags = watcher.shared_flags(data['UID'], flags)
         return Message(
-            self._key(data['UID']), self.container, data['ENVELOPE'],
-            data['FLAGS'])
+            self._key(data['UID']), self.container, data['ENVELOPE'], flags)
 
-    def values(self):
+    @gocept.imapapi.instrumentation.operation('Messages.itervalues')
+    def itervalues(self):
+        """Yield the messages of the container as they arrive."""
         lines = self._fetch_lines(
             '%s:%s' % (1, len(self)), '(UID ENVELOPE FLAGS)')
-        return [self._make_message(line) for line in lines]
+        for line in lines:
+            yield self._make_message(line)
+
+    @gocept.imapapi.instrumentation.operation('Messages.values')
+    def values(self):
+        return list(self.itervalues())
+
+    @gocept.imapapi.instrumentation.operation('Messages.batch')
+    def batch(self):
+        """Fetch UIDs, sizes, flags and envelopes of all messages into a
+        MessageBatch.
+
+        """
+        batch = MessageBatch(self)
+        lines = self._fetch_lines(
+            '%s:%s' % (1, len(self)), '(UID RFC822.SIZE FLAGS ENVELOPE)')
+        for line in lines:
+            batch.append_response(line)
+        return batch
+
+    @gocept.imapapi.instrumentation.operation('Messages.iter_by_uids')
+    def iter_by_uids(self, uids):
+        """Yield the messages with the given keys as they arrive."""
+        uids = ','.join(self._split_uid(uid) for uid in uids)
+        lines = self._fetch_lines(uids, '(UID ENVELOPE FLAGS)', uid=True)
+        for line in lines:
+            yield self._make_message(line)
 
+    @gocept.imapapi.instrumentation.operation('Messages.by_uids')
     def by_uids(self, uids):
         # XXX naming of this method sucks :/
-        uids = ','.join(self._split_uid(uid) for uid in uids)
-        self.container._select()
-        try:
-            code, data = self.container.server.UID(
-                'FETCH', uids, '(UID ENVELOPE FLAGS)')
-        except imaplib.IMAP4.error:
-            # Messages might have been deleted (Dovecot).
-            return []
-        if code == 'NO':
-            # Messages might have been deleted (Cyrus).
-            return []
-        return [self._make_message(line)
-                for line in gocept.imapapi.parser.unsplit(data)]
+        return list(self.iter_by_uids(uids))
 
+    @gocept.imapapi.instrumentation.operation('Messages.__getitem__')
     def __getitem__(self, key):
         self.container._select()
         uid = self._split_uid(key)
@@ -408,55 +500,123 @@ class Messages(UserDict.DictMixin):
             raise KeyError(key)
         return self._make_message(data)
 
+    @gocept.imapapi.instrumentation.operation('Messages.__delitem__')
     def __delitem__(self, key):
         if isinstance(key, slice):
             self._delslice(key)
             return
 
-        # XXX This method should not access the message count cache of its
-        # container directly. Ideally, it should not even have to care about
-        # the message count; this is what EXPUNGE responses are for.
-        message = self[key]
-        message.flags.add('\\Deleted')
-        self.container._select()
-        self.container.server.expunge()
-        if self.container._message_count_cache is not None:
-            self.container._message_count_cache -= 1
+        self[key]
+        self._delete([self._split_uid(key)])
 
     def __delslice__(self, begin, end):
         self._delslice(slice(begin, end))
 
+    @gocept.imapapi.instrumentation.operation('Messages.__delitem__')
     def _delslice(self, slice):
-        # XXX This method should not access the message count cache of its
-        # container directly. Ideally, it should not even have to care about
-        # the message count; this is what EXPUNGE responses are for.
         keys = self.keys()[slice.start:slice.stop:slice.step]
-        for key in keys:
-            message = self[key]
-            message.flags.add('\\Deleted')
-        self.container._select()
-        self.container.server.expunge()
-        if self.container._message_count_cache is not None:
-            self.container._message_count_cache -= len(keys)
+        if keys:
+            self._delete([self._split_uid(key) for key in keys])
 
-    def add(self, message):
-        # XXX This method should not access the message count cache of its
-        # container directly. Ideally, it should not even have to care about
-        # the message count; this is what EXISTS responses are for.
+    def _delete(self, uids):
+        """Flag messages as deleted and expunge them in a single round trip.
+
+        Without UIDPLUS, other messages flagged as deleted are expunged, too.
+
+        """
+        server = self.container.server
+        count = len(uids)
+        uids = ','.join(str(uid) for uid in uids)
+        pipeline = server.pipeline()
+        self.container._select(pipeline)
+        pipeline.uid('STORE', uids, '+FLAGS.SILENT', '(\\Deleted)')
+        if server.capabilities.expunge == 'UID EXPUNGE':
+            pipeline.uid('EXPUNGE', uids)
+        else:
+            pipeline.command('EXPUNGE', 'EXPUNGE')
+        for code, data in pipeline.execute():
+            assert code == 'OK', '%s %r' % (code, data)
+        if server.capabilities.expunge == 'UID EXPUNGE':
+            self.container._written(-count)
+        else:
+            # We don't know how many messages were expunged.
+            self.container._written(None)
+
+    @gocept.imapapi.instrumentation.operation('Messages.move')
+    def move(self, keys, target):
+        """Move messages to another folder of the same account.
+
+        Uses MOVE if the server supports it, or else copies the messages and
+        deletes the originals.
+
+        """
         container = self.container
-        if isinstance(message, Message):
-            message = message.raw
-        # XXX Timezone handling!
-        container.server.append(
-            container.encoded_path, '', time.localtime(), message)
-        if self.container._message_count_cache is not None:
-            self.container._message_count_cache += 1
+        keys = list(keys)
+        if not keys:
+            return
+        uids = ','.join(self._split_uid(key) for key in keys)
+        server = container.server
+        container._select()
+        if server.capabilities.move == 'MOVE':
+            code, data = server.uid('MOVE', uids, target.encoded_path)
+        else:
+            code, data = server.uid('COPY', uids, target.encoded_path)
+        if code != 'OK':
+            raise gocept.imapapi.interfaces.IMAPError(
+                'Could not move messages to %r: %s' % (
+                    target.encoded_path, data[0]))
+        if server.capabilities.move == 'MOVE':
+            container._written(-len(keys))
+        else:
+            self._delete(uids.split(','))
+        target._written(len(keys))
+
+    @gocept.imapapi.instrumentation.operation('Messages.add')
+    def add(self, message):
+        self.add_many([message])
+
+    @gocept.imapapi.instrumentation.operation('Messages.add_many')
+    def add_many(self, messages):
+        """Add messages to the container.
+
+        Messages may be given as Message objects, strings or files. They are
+        consumed from the iterable while sending them, so a large number of
+        messages need not be in memory at the same time.
+
+        Returns a list of the new messages' keys. Keys are None where the
+        server doesn't report the UIDs assigned (UIDPLUS, RfC 4315).
 
+        """
+        container = self.container
+        results = container.server.append_many(
+            container.encoded_path, self._append_items(messages))
+        keys = []
+        for code, data, count in results:
+            if code != 'OK':
+                raise gocept.imapapi.interfaces.IMAPError(
+                    'Could not append messages to %r: %s' % (
+                        container.encoded_path, data[0]))
+            container._written(count)
+            appended = gocept.imapapi.parser.appenduid(data[0])
+            if appended is None or len(appended[1]) != count:
+                keys.extend([None] * count)
+                continue
+            uidvalidity, uids = appended
+            keys.extend('%s-%s' % (uidvalidity, uid) for uid in uids)
+        return keys
+
+    def _append_items(self, messages):
+        for message in messages:
+            if isinstance(message, Message):
+                message = message.raw
+            # XXX Timezone handling!
+            yield '', time.localtime(), message
+
+    @gocept.imapapi.instrumentation.operation('Messages.filtered')
     def filtered(self, sort_by=None, sort_dir='asc',
                  filter_by=None, filter_value=None):
         # XXX make API for sort_by not IMAP-syntax specific.
         sort_criterion = (sort_by or 'ARRIVAL').upper()
-        self.container._select()
         if sort_criterion == 'FROM_NAME':
             # we want to sort by *name* and address, but since IMAP SORT only
             # support sorting by address, we need to roll our own.
@@ -470,14 +630,61 @@ class Messages(UserDict.DictMixin):
 
     def _filtered_by_imap(self, sort_criterion, sort_dir,
                           filter_by, filter_value):
+        capabilities = self.container.server.capabilities
+        if capabilities.sort is None:
+            return self._filtered_by_client(
+                sort_criterion, sort_dir, filter_by, filter_value)
         if sort_dir == 'desc':
             sort_criterion = 'REVERSE ' + sort_criterion
-        code, data = self.container.server.uid(
-            'SORT', '(%s)' % sort_criterion, 'UTF-8',
-            *self._search_criteria(filter_by, filter_value))
+        # Selecting the folder and sorting cost only one round trip.
+        pipeline = self.container.server.pipeline()
+        self.container._select(pipeline)
+        criteria = self._search_criteria(filter_by, filter_value)
+        if capabilities.sort == 'ESORT':
+            pipeline.uid('SORT', 'RETURN', '(ALL)', '(%s)' % sort_criterion,
+                         'UTF-8', *criteria)
+        else:
+            pipeline.uid('SORT', '(%s)' % sort_criterion, 'UTF-8', *criteria)
+        code, data = pipeline.execute()[-1]
         assert code == 'OK'
-        uids = gocept.imapapi.parser.search(data)
-        return uids
+        if capabilities.sort == 'ESORT':
+            return gocept.imapapi.parser.esearch(data).get('ALL', [])
+        return gocept.imapapi.parser.search(data)
+
+    def _filtered_by_client(self, sort_criterion, sort_dir,
+                            filter_by, filter_value):
+        """Search and sort messages without the SORT extension."""
+        if sort_criterion == 'ARRIVAL':
+            uids = self._search(filter_by, filter_value)
+            if sort_dir == 'desc':
+                uids.reverse()
+            return uids
+        if sort_criterion == 'SIZE':
+            return self._filtered_by_size(sort_dir, filter_by, filter_value)
+        if sort_criterion not in CLIENT_SORT_KEYS:
+            raise ValueError('Invalid sort criterion %r' % sort_criterion)
+        field, key = CLIENT_SORT_KEYS[sort_criterion]
+        return self._filtered_by_header(
+            field, key, sort_dir, filter_by, filter_value)
+
+    def _search(self, filter_by, filter_value):
+        """Return the UIDs of the messages that pass the filter, ascending."""
+        capabilities = self.container.server.capabilities
+        pipeline = self.container.server.pipeline()
+        self.container._select(pipeline)
+        criteria = self._search_criteria(filter_by, filter_value)
+        if capabilities.search == 'ESEARCH':
+            pipeline.uid('SEARCH', 'RETURN', '(ALL)', 'CHARSET', 'UTF-8',
+                         *criteria)
+        else:
+            pipeline.uid('SEARCH', 'CHARSET', 'UTF-8', *criteria)
+        code, data = pipeline.execute()[-1]
+        assert code == 'OK'
+        if capabilities.search == 'ESEARCH':
+            uids = gocept.imapapi.parser.esearch(data).get('ALL', [])
+        else:
+            uids = gocept.imapapi.parser.search(data)
+        return sorted(uids)
 
     def _search_criteria(self, filter_by, filter_value):
         if filter_by is None or filter_value is None or filter_value == '':
@@ -509,6 +716,8 @@ class Messages(UserDict.DictMixin):
                             filter_by, filter_value):
         uids = self._filtered_by_imap(
             'ARRIVAL', 'asc', filter_by, filter_value)
+        if not uids:
+            return []
         uids = ','.join(str(uid) for uid in uids)
         code, data = self.container.server.uid(
             'FETCH', uids, '(BODY[HEADER.FIELDS (%s)])' % field)
@@ -530,6 +739,21 @@ class Messages(UserDict.DictMixin):
             result.reverse()
         return result
 
+    def _filtered_by_size(self, sort_dir, filter_by, filter_value):
+        uids = self._search(filter_by, filter_value)
+        if not uids:
+            return []
+        code, data = self.container.server.uid(
+            'FETCH', ','.join(str(uid) for uid in uids), '(RFC822.SIZE)')
+        assert code == 'OK'
+        items = gocept.imapapi.parser.fetch(data, fetch_all=True)
+        items.sort(key=lambda item: gocept.imapapi.parser.number(
+            item['RFC822.SIZE']))
+        result = [item['UID'] for item in items]
+        if sort_dir == 'desc':
+            result.reverse()
+        return result
+
     def from_name(self, value):
         name, addr = email.Utils.parseaddr(value)
         return (name + addr).lower()
@@ -566,6 +790,178 @@ class LazyMessageSequence(object):
         return len(self.uids)
 
 
+class FlagTable(object):
+    """Assigns a bit to each flag seen in a folder.
+
+    Sets of flags are represented as integer bitmasks against the table:
+
+    >>> table = FlagTable()
+    >>> table.mask(['\\\\Seen', '\\\\Flagged'])
+    3
+    >>> table.mask(['$Label1', '\\\\Seen'])
+    5
+    >>> sorted(table.flags(6))
+    ['$Label1', '\\\\Flagged']
+
+    Looking a flag up doesn't add it to the table. A flag not seen yet has no
+    bit, so it matches no message:
+
+    >>> table.lookup('\\\\Deleted')
+    0
+    >>> len(table.names)
+    3
+
+    """
+
+    def __init__(self):
+        self.bits = {}
+        self.names = []
+
+    def bit(self, flag):
+        try:
+            return self.bits[flag]
+        except KeyError:
+            bit = self.bits[flag] = 1 << len(self.names)
+            self.names.append(flag)
+            return bit
+
+    def lookup(self, flag):
+        return self.bits.get(flag, 0)
+
+    def mask(self, flags):
+        mask = 0
+        for flag in flags:
+            mask |= self.bit(flag)
+        return mask
+
+    def flags(self, mask):
+        return set(name for i, name in enumerate(self.names)
+                   if mask & (1 << i))
+
+
+class MessageBatch(object):
+    """Columns of UIDs, sizes, flags and envelope data of many messages.
+
+    UIDs and sizes are kept in arrays, flags as bitmasks against the flag
+    table of the folder and envelope fields as raw values in one list per
+    field. Messages are views onto a row that are only created on access.
+
+    """
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.flag_table = messages.container.flag_table
+        self.uids = array.array('L')
+        self.sizes = array.array('L')
+        self.flags = array.array('L')
+        self.envelope = [[] for field in gocept.imapapi.parser.ENVELOPE_FIELDS]
+
+    def append_response(self, line):
+        """Add the row of a FETCH (UID RFC822.SIZE FLAGS ENVELOPE) response.
+        """
+        msg_number, response = gocept.imapapi.parser.parse(line)
+        row = {}
+        for key, value in gocept.imapapi.parser.iterate_pairs(response):
+            row[key.value] = value
+        for key in ('UID', 'RFC822.SIZE', 'FLAGS', 'ENVELOPE'):
+            if key not in row:
+                # Servers may send other FETCH responses while the batch is
+                # being fetched, e.g. when another client changes flags. Only
+                # complete rows are added so the columns stay in line.
+                return
+        envelope = list(row['ENVELOPE'])
+        if len(envelope) != len(self.envelope):
+            raise ValueError(
+                'Unexpected number of envelope fields in %r' % line)
+        uid = int(row['UID'].value)
+        size = int(row['RFC822.SIZE'].value)
+        mask = self.flag_table.mask(str(flag) for flag in row['FLAGS'])
+
+        self.uids.append(uid)
+        self.sizes.append(size)
+        try:
+            self.flags.append(mask)
+        except OverflowError:
+            # More flags than bits in an array item.
+            self.flags = list(self.flags)
+            self.flags.append(mask)
+        for column, field in zip(self.envelope, envelope):
+            column.append(field)
+
+    def __len__(self):
+        return len(self.uids)
+
+    def __getitem__(self, i):
+        envelope = gocept.imapapi.parser.Envelope(
+            [column[i] for column in self.envelope])
+        return Message(self.messages._key(self.uids[i]),
+                       self.messages.container, envelope,
+                       self.flag_table.flags(self.flags[i]))
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def column(self, field):
+        """Return the decoded values of an envelope field for all rows."""
+        index = gocept.imapapi.parser.ENVELOPE_FIELDS.index(field)
+        return [decode_header(gocept.imapapi.parser.envelope_field(value))
+                for value in self.envelope[index]]
+
+    def filter(self, flag, present=True):
+        """Return the row numbers of messages with or without a flag."""
+        bit = self.flag_table.lookup(flag)
+        if present:
+            return [i for i, mask in enumerate(self.flags) if mask & bit]
+        return [i for i, mask in enumerate(self.flags) if not mask & bit]
+
+    def count(self, flag, present=True):
+        """Count the messages with or without a flag."""
+        return len(self.filter(flag, present))
+
+    def unread_count(self):
+        return self.count('\\Seen', present=False)
+
+    def sort(self, column, reverse=False):
+        """Return the row numbers ordered by `uid`, `size` or an envelope
+        field.
+
+        Dates, addresses and subjects are compared like when sorting without
+        the SORT extension (see CLIENT_SORT_KEYS), other envelope fields by
+        their decoded value:
+
+        >>> class Folder(object):
+        ...     flag_table = FlagTable()
+        >>> class Messages(object):
+        ...     container = Folder()
+        >>> batch = MessageBatch(Messages())
+        >>> for uid, date in [(1, 'Mon, 02 Feb 2009 10:00:00 +0100'),
+        ...                   (2, 'Tue, 01 Jan 2008 10:00:00 +0100'),
+        ...                   (3, 'Sat, 31 Jan 2009 10:00:00 +0100')]:
+        ...     batch.append_response(
+        ...         '%s (UID %s RFC822.SIZE 100 FLAGS () ENVELOPE ("%s" "Hi" '
+        ...         'NIL NIL NIL NIL NIL NIL NIL NIL))' % (uid, uid, date))
+        >>> [int(batch.uids[i]) for i in batch.sort('date')]
+        [2, 3, 1]
+        >>> [int(batch.uids[i]) for i in batch.sort('date', reverse=True)]
+        [1, 3, 2]
+
+        """
+        if column == 'uid':
+            values = self.uids
+        elif column == 'size':
+            values = self.sizes
+        elif column.upper() in CLIENT_SORT_KEYS:
+            field, key = CLIENT_SORT_KEYS[column.upper()]
+            index = gocept.imapapi.parser.ENVELOPE_FIELDS.index(column)
+            values = [key(gocept.imapapi.parser.envelope_field(value))
+                      for value in self.envelope[index]]
+        else:
+            values = self.column(column)
+        return sorted(xrange(len(self)), key=values.__getitem__,
+                      reverse=reverse)
+
+
 def update(func):
     def wrapped(self, *args, **kw):
         if self.flags is None:
@@ -578,9 +974,12 @@ class Flags(object):
 
     def __init__(self, message, flags=None):
         self.message = message
-        self.server = self.message.server
         self.flags = flags
 
+    @property
+    def server(self):
+        return self.message.server
+
     @update
     def __repr__(self):
         return repr(self.flags).replace('set([', 'flags([')
@@ -597,12 +996,15 @@ class Flags(object):
     def __contains__(self, flag):
         return flag in self.flags
 
+    @gocept.imapapi.instrumentation.operation('Flags.add')
     def add(self, flag):
         self._store(flag, '+')
 
+    @gocept.imapapi.instrumentation.operation('Flags.remove')
     def remove(self, flag):
         self._store(flag, '-')
 
+    @gocept.imapapi.instrumentation.operation('Message.flags')
     def _update(self, data=None):
         if data is None or data == [None]:
             # None: called without a previous FETCH or STORE
@@ -617,6 +1019,7 @@ class Flags(object):
         code, data = self.server.uid(
             'STORE', '%s' % self.message.UID, '%sFLAGS' % sign, '(%s)' % flag)
         assert code == 'OK'
+        self.message.parent._written()
         if sign == '+':
             self.flags.add(flag)
         else:
@@ -642,8 +1045,14 @@ def _fetch(server, mailbox, msg_uid, data_item, chunk_no=None):
     assert code == 'OK'
     __traceback_info__ = 'Server %s:%s, response to FETCH %s %s: %s, %r' % (
         server.host, server.port, msg_uid, data_item_req, code, data)
-    data = gocept.imapapi.parser.fetch(data)
-    return data[data_item_resp]
+    data = gocept.imapapi.parser.fetch(data)[data_item_resp]
+    if (chunk_no is None and
+        isinstance(data, gocept.imapapi.imap.SpooledLiteral)):
+        # Only chunked fetches know how to deal with spooled literals.
+        literal = data
+        data = literal.read()
+        literal.close()
+    return data
 
 
 def fallback_decode(text, encoding='ascii'):
@@ -0,0 +1,351 @@
+# Copyright (c) 2011 gocept gmbh & co. kg
+# See also LICENSE.txt
+"""Copy the messages of a folder to a folder on another server."""
+
+import Queue
+import gocept.imapapi.imap
+import gocept.imapapi.instrumentation
+import gocept.imapapi.interfaces
+import gocept.imapapi.parser
+import gocept.imapapi.resync
+import imaplib
+import socket
+import sys
+import threading
+
+# Messages fetched by a single command, and messages a worker appends before
+# recording its progress.
+FETCH_CHUNK_SIZE = 100
+APPEND_CHUNK_SIZE = 100
+
+# Messages fetched but not appended yet. Large messages wait in temporary
+# files, see gocept.imapapi.imap.LITERAL_SPOOL_THRESHOLD.
+QUEUE_SIZE = 200
+
+FETCH_WORKERS = 2
+APPEND_WORKERS = 2
+
+
+class Progress(object):
+    """The messages copied so far by folder path, UIDVALIDITY and UID.
+
+    Copying a folder again skips the messages copied before, so a migration
+    that has been interrupted may be resumed. Progress converts to and from
+    plain data so it can be persisted, e.g. by a `save` callable which is
+    called with the progress each time a chunk of messages has been copied.
+
+    >>> progress = Progress()
+    >>> progress.add('INBOX', 1234, [1, 2, 3, 7])
+    >>> progress.done('INBOX', 1234, 2), progress.done('INBOX', 1235, 2)
+    (True, False)
+    >>> progress.as_dict()
+    {'INBOX': {'1234': '1:3,7'}}
+    >>> Progress.from_dict(progress.as_dict()).done('INBOX', 1234, 7)
+    True
+
+    """
+
+    def __init__(self, save=None):
+        self.save = save
+        # (path, UIDVALIDITY) -> set of UIDs
+        self.copied = {}
+        self.lock = threading.RLock()
+
+    def done(self, path, uidvalidity, uid):
+        self.lock.acquire()
+        try:
+            return uid in self.copied.get((path, uidvalidity), ())
+        finally:
+            self.lock.release()
+
+    def add(self, path, uidvalidity, uids):
+        self.lock.acquire()
+        try:
+            self.copied.setdefault((path, uidvalidity), set()).update(uids)
+            # Saving while holding the lock keeps an older state from
+            # overwriting a newer one.
+            if self.save is not None:
+                self.save(self)
+        finally:
+            self.lock.release()
+
+    def as_dict(self):
+        self.lock.acquire()
+        try:
+            data = {}
+            for (path, uidvalidity), uids in self.copied.items():
+                data.setdefault(path, {})[str(uidvalidity)] = (
+                    gocept.imapapi.resync.sequence_set(sorted(uids)))
+            return data
+        finally:
+            self.lock.release()
+
+    @classmethod
+    def from_dict(cls, data, save=None):
+        progress = cls(save)
+        for path, folder in data.items():
+            for uidvalidity, uids in folder.items():
+                progress.copied[path, int(uidvalidity)] = set(
+                    uids and gocept.imapapi.parser.sequence_set(uids) or [])
+        return progress
+
+
+class Connections(object):
+    """The connections of the workers copying messages between two
+    accounts.
+
+    Workers take a connection when they start and put it back when they are
+    done, so moving a tree of folders logs in only as many connections as
+    there are workers. `close` logs them out.
+
+    """
+
+    def __init__(self, source, target):
+        self.accounts = dict(source=source, target=target)
+        self.idle = dict(source=[], target=[])
+        self.lock = threading.Lock()
+
+    def get(self, side):
+        self.lock.acquire()
+        try:
+            if self.idle[side]:
+                return self.idle[side].pop()
+        finally:
+            self.lock.release()
+        return self.accounts[side].connect()
+
+    def put(self, side, connection):
+        self.lock.acquire()
+        try:
+            self.idle[side].append(connection)
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """Log out all connections."""
+        self.lock.acquire()
+        try:
+            connections = self.idle['source'] + self.idle['target']
+            self.idle = dict(source=[], target=[])
+        finally:
+            self.lock.release()
+        for connection in connections:
+            try:
+                connection.logout()
+            except (imaplib.IMAP4.error, socket.error):
+                pass
+            gocept.imapapi.imap.close_quietly(connection)
+
+
+class Migration(object):
+    """Copies the messages of a folder to a folder on another server.
+
+    Fetch workers stream chunks of messages from the source over connections
+    of their own into a bounded queue. Append workers take them from the
+    queue and send them to the target, using MULTIAPPEND and pipelining as
+    the target server allows. Fetching and appending thus overlap, and the
+    queue keeps fetch workers from getting too far ahead. Flags and internal
+    dates are kept.
+
+    Workers take their connections from `connections`, which may be shared
+    by the migrations of several folders. Without them, connections are
+    opened for this migration only.
+
+    """
+
+    def __init__(self, source, target, progress=None, connections=None,
+                 fetch_workers=FETCH_WORKERS, append_workers=APPEND_WORKERS,
+                 queue_size=QUEUE_SIZE):
+        self.source = source
+        self.target = target
+        if progress is None:
+            progress = Progress()
+        self.progress = progress
+        self.connections = connections
+        self.fetch_workers = fetch_workers
+        self.append_workers = append_workers
+        self.chunks = Queue.Queue()
+        self.messages = Queue.Queue(queue_size)
+        self.errors = []
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def run(self):
+        """Copy the messages not copied before.
+
+        Returns the number of messages copied.
+
+        """
+        path = self.source.encoded_path
+        self.uidvalidity = uidvalidity = self.source.uidvalidity
+        uids = [uid for uid in self.source.messages._search(None, None)
+                if not self.progress.done(path, uidvalidity, uid)]
+        for start in xrange(0, len(uids), FETCH_CHUNK_SIZE):
+            self.chunks.put(uids[start:start + FETCH_CHUNK_SIZE])
+        if not uids:
+            return 0
+
+        connections = self.connections
+        if connections is None:
+            connections = Connections(self.source.account,
+                                      self.target.account)
+        try:
+            fetchers = [
+                self._start(self._fetch, connections, 'source')
+                for i in xrange(min(self.fetch_workers,
+                                    self.chunks.qsize()))]
+            appenders = [self._start(self._append, connections, 'target')
+                         for i in xrange(self.append_workers)]
+            for thread in fetchers:
+                thread.join()
+            for thread in appenders:
+                self._put(None)
+            for thread in appenders:
+                thread.join()
+        finally:
+            if self.connections is None:
+                connections.close()
+        if self.errors:
+            type, value, traceback = self.errors[0]
+            raise type, value, traceback
+        return self.count
+
+    def _start(self, work, connections, side):
+        def run():
+            connection = None
+            try:
+                connection = connections.get(side)
+                work(connection)
+            except Exception:
+                self.errors.append(sys.exc_info())
+                # The connection may be in the middle of a command.
+                if connection is not None:
+                    gocept.imapapi.imap.close_quietly(connection)
+            else:
+                connections.put(side, connection)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _put(self, item):
+        # Workers stop as soon as one of them has failed.
+        while not self.errors:
+            try:
+                self.messages.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        if item is not None:
+            item.close()
+        return False
+
+    def _get(self):
+        while not self.errors:
+            try:
+                return self.messages.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+
+    @gocept.imapapi.instrumentation.operation('Migration.fetch')
+    def _fetch(self, connection):
+        code, data = connection.select(self.source.encoded_path)
+        assert code == 'OK', '%s %r' % (code, data)
+        uidvalidity = int(
+            connection.server.untagged_responses['UIDVALIDITY'][-1])
+        if uidvalidity != self.uidvalidity:
+            raise gocept.imapapi.interfaces.IMAPError(
+                'UIDVALIDITY of %r changed from %s to %s' % (
+                    self.source.encoded_path, self.uidvalidity, uidvalidity))
+        while not self.errors:
+            try:
+                uids = self.chunks.get_nowait()
+            except Queue.Empty:
+                return
+            lines = connection.stream(
+                'FETCH', 'UID', 'FETCH',
+                gocept.imapapi.resync.sequence_set(uids),
+                '(UID FLAGS INTERNALDATE BODY.PEEK[])')
+            for line in lines:
+                data = gocept.imapapi.parser.fetch(line)
+                if 'UID' not in data or 'BODY[]' not in data:
+                    # Servers may report flag changes by other sessions
+                    # while the messages are being fetched.
+                    continue
+                if not self._put(FetchedMessage(data)):
+                    lines.close()
+                    return
+
+    @gocept.imapapi.instrumentation.operation('Migration.append')
+    def _append(self, connection):
+        ended = []
+
+        def chunk(items):
+            while len(items) < APPEND_CHUNK_SIZE:
+                item = self._get()
+                if item is None:
+                    ended.append(True)
+                    return
+                items.append(item)
+                yield item.flags, item.internaldate, item.body
+
+        try:
+            while not ended:
+                items = []
+                try:
+                    results = connection.append_many(
+                        self.target.encoded_path, chunk(items))
+                finally:
+                    for item in items:
+                        item.close()
+                # Each command carries the next `count` messages taken.
+                copied = []
+                failed = None
+                for code, data, count in results:
+                    if code == 'OK':
+                        copied.extend(item.uid for item in items[:count])
+                    elif failed is None:
+                        failed = data[0]
+                    items = items[count:]
+                if copied:
+                    self.progress.add(
+                        self.source.encoded_path, self.uidvalidity, copied)
+                    self.lock.acquire()
+                    try:
+                        self.count += len(copied)
+                    finally:
+                        self.lock.release()
+                if failed is not None:
+                    raise gocept.imapapi.interfaces.IMAPError(
+                        'Could not append messages to %r: %s' % (
+                            self.target.encoded_path, failed))
+        finally:
+            self.target._written(None)
+
+
+class FetchedMessage(object):
+    """A message on its way from the source to the target folder."""
+
+    def __init__(self, data):
+        self.uid = data['UID']
+        # \Recent is set by the server and can't be appended.
+        flags = [flag for flag in data['FLAGS']
+                 if str(flag).upper() != '\\RECENT']
+        self.flags = flags and '(%s)' % ' '.join(sorted(flags)) or ''
+        self.internaldate = '"%s"' % data['INTERNALDATE']
+        self.body = data['BODY[]']
+
+    def close(self):
+        if not isinstance(self.body, basestring):
+            self.body.close()
+
+
+def copy_messages(source, target, progress=None, connections=None,
+                  **options):
+    """Copy all messages of a folder to a folder of another account.
+
+    Messages recorded by the progress as copied before are skipped. See
+    `Migration` for the options. Returns the number of messages copied.
+
+    """
+    return Migration(source, target, progress, connections, **options).run()
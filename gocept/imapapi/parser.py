@@ -3,6 +3,10 @@
 # See also LICENSE.txt
 """Parsing IMAP responses."""
 
+import UserDict
+import re
+
+
 def iterate_pairs(iterable):
     iterable = iter(iterable)
     while True:
@@ -17,20 +21,66 @@ def dict_from_sequence(sequence):
     return result
 
 
+class Response(str):
+    """A response line whose large literals have been left out.
+
+    `literals` maps the index in the line at which each literal would start
+    to the file-like object holding it.
+
+    """
+
+    literals = None
+
+
 def unsplit(items):
-    """Restore the raw IMAP response from what imaplib server commands return.
+    r"""Restore the raw IMAP response from what imaplib server commands return.
+
+    >>> list(unsplit(['1 (FLAGS ())', ('2 (BODY[] {3}', 'foo'), ')']))
+    ['1 (FLAGS ())', '2 (BODY[] {3}\r\nfoo)']
+
+    Literals that imaplib didn't read into a string are not copied into the
+    line but passed on to the parser:
+
+    >>> class Spooled(object):
+    ...     def __len__(self):
+    ...         return 3
+    >>> literal = Spooled()
+    >>> line, = unsplit([('2 (BODY[] {3}', literal), ')'])
+    >>> line
+    '2 (BODY[] {3}\r\n)'
+    >>> parse(line)[1][1] is literal
+    True
 
     """
     if items == [None]:
         return
-    line = ''
+    pieces = []
+    length = 0
+    literals = None
     for item in items:
         if type(item) is tuple:
-            line += '\r\n'.join(item)
+            prefix, literal = item
+            pieces.append(prefix)
+            pieces.append('\r\n')
+            length += len(prefix) + 2
+            if isinstance(literal, str):
+                pieces.append(literal)
+                length += len(literal)
+            else:
+                if literals is None:
+                    literals = {}
+                literals[length] = literal
         else:
-            yield line + item
-            line = ''
-    assert not line
+            pieces.append(item)
+            line = ''.join(pieces)
+            if literals is not None:
+                line = Response(line)
+                line.literals = literals
+            yield line
+            pieces = []
+            length = 0
+            literals = None
+    assert not pieces
 
 
 def mailbox_list(line):
@@ -48,7 +98,7 @@ def mailbox_list(line):
 
     """
     flags, sep, name = parse(line)
-    if sep == NIL:
+    if sep is NIL:
         sep = None
     return flags, sep, mailbox(name)
 
@@ -56,11 +106,25 @@ def mailbox_list(line):
 def status(line):
     """Parse an IMAP `status` response.
     """
-    foldername, response = parse(line)
+    return mailbox_status(line)[1]
+
+
+def mailbox_status(line):
+    """Parse an IMAP `status` response.
+
+    Returns a tuple: (name, status)
+
+    >>> mailbox_status('"INBOX/Baz" (MESSAGES 3)')
+    ('INBOX/Baz', {'MESSAGES': 3})
+    >>> mailbox_status('INBOX (UNSEEN 0)')
+    ('INBOX', {'UNSEEN': 0})
+
+    """
+    name, response = parse(line)
     status = {}
     for key, value in iterate_pairs(response):
         status[str(key)] = number(value)
-    return status
+    return mailbox(name), status
 
 
 def fetch(line, fetch_all=False):
@@ -95,41 +159,214 @@ def search(line):
 
     >>> search(['12 14',])
     [12, 14]
+    >>> search([None])
+    []
 
     """
-    line = unsplit(line).next()
+    line = next(unsplit(line), None)
+    if line is None:
+        return []
     return [number(x) for x in parse(line)]
 
 
-def _parse_envelope(envelope):
-    envelope = dict(zip(['date', 'subject', 'from', 'sender', 'reply-to',
-                         'to', 'cc', 'bcc', 'in-reply-to', 'message-id'],
-                        envelope))
-    for key, value in envelope.iteritems():
-        if value == NIL:
-            envelope[key] = u''
-        elif isinstance(value, str):
+APPENDUID = re.compile(r'\[APPENDUID (\d+) ([\d:,]+)\]', re.IGNORECASE)
+
+
+def appenduid(line):
+    """Parse the APPENDUID response code of a completed APPEND (RfC 4315).
+
+    Returns the UID validity and the UIDs of the messages appended, or None
+    if the server didn't report them.
+
+    >>> appenduid('[APPENDUID 38505 3955:3957,3960] APPEND completed')
+    (38505, [3955, 3956, 3957, 3960])
+    >>> print appenduid('APPEND completed')
+    None
+
+    """
+    match = APPENDUID.search(line or '')
+    if match is None:
+        return None
+    return int(match.group(1)), sequence_set(match.group(2))
+
+
+def sequence_set(value):
+    """Expand a set of message numbers or UIDs given as ranges.
+
+    Ranges are expanded in the direction given, so the order of results
+    sorted by the server is kept.
+
+    >>> sequence_set('3955:3957,3960')
+    [3955, 3956, 3957, 3960]
+    >>> sequence_set('7,5:3')
+    [7, 5, 4, 3]
+
+    """
+    result = []
+    for part in value.split(','):
+        first, sep, last = part.partition(':')
+        first = int(first)
+        last = int(last or first)
+        if first <= last:
+            result.extend(xrange(first, last + 1))
+        else:
+            result.extend(xrange(first, last - 1, -1))
+    return result
+
+
+def vanished(lines):
+    """Parse IMAP `vanished` responses (RfC 7162) into a list of UIDs.
+
+    >>> vanished(['(EARLIER) 41,43:45', '7'])
+    [41, 43, 44, 45, 7]
+
+    """
+    result = []
+    for line in lines:
+        if line is None:
+            continue
+        if line[:9].upper() == '(EARLIER)':
+            line = line[9:]
+        result.extend(sequence_set(line.strip()))
+    return result
+
+
+def esearch(line):
+    """Parse an IMAP `esearch` response (RfC 4731), also sent for SORT with
+    a RETURN option (RfC 5267).
+
+    Returns the result items by name. The numbers of ALL are expanded.
+
+    >>> result = esearch(['(TAG "A7") UID ALL 17,3:5 COUNT 4'])
+    >>> result['ALL'], result['COUNT']
+    ([17, 3, 4, 5], 4)
+    >>> esearch(['(TAG "A8") UID'])
+    {}
+
+    Servers may leave out the response if nothing matched:
+
+    >>> esearch([None])
+    {}
+
+    """
+    line = next(unsplit(line), None)
+    if line is None:
+        return {}
+    items = parse(line)
+    if items and isinstance(items[0], list):
+        # Correlator: (TAG "...")
+        items = items[1:]
+    if items and str(items[0]).upper() == 'UID':
+        items = items[1:]
+    result = {}
+    for key, value in iterate_pairs(items):
+        key = str(key).upper()
+        if key == 'ALL':
+            result[key] = sequence_set(str(value))
+        else:
+            result[key] = number(value)
+    return result
+
+
+ENVELOPE_FIELDS = ['date', 'subject', 'from', 'sender', 'reply-to',
+                   'to', 'cc', 'bcc', 'in-reply-to', 'message-id']
+
+
+class Envelope(UserDict.DictMixin):
+    """The fields of an ENVELOPE, each decoded when first accessed.
+
+    >>> envelope = Envelope(parse(
+    ...     '"Mon, 7 Feb 1994" NIL (("Fred" NIL "fred" "example.com")) '
+    ...     '(("Fred" NIL "fred" "example.com") (NIL NIL "joe" "example.com"))'
+    ...     ' NIL NIL NIL NIL NIL "<1234@example.com>"'))
+    >>> envelope['date']
+    'Mon, 7 Feb 1994'
+    >>> envelope['subject']
+    u''
+    >>> envelope['sender']
+    'Fred <fred@example.com>, joe@example.com'
+    >>> envelope._decoded.keys()
+    ['date', 'sender', 'subject']
+    >>> envelope['x-foo']
+    Traceback (most recent call last):
+    KeyError: 'x-foo'
+
+    """
+
+    def __init__(self, envelope):
+        self._raw = envelope
+        self._decoded = {}
+
+    def __getitem__(self, key):
+        try:
+            return self._decoded[key]
+        except KeyError:
             pass
-        elif isinstance(value, list):
-            # XXX handle RfC2822-style address groups
-            addresses = []
-            for item in value:
-                name, path, mailbox, host = item
-                if name == NIL:
-                    addresses.append('%s@%s' % (mailbox, host))
-                else:
-                    addresses.append('%s <%s@%s>' % (name, mailbox, host))
-            envelope[key] = ', '.join(addresses)
-    return envelope
+        try:
+            value = self._raw[ENVELOPE_FIELDS.index(key)]
+        except (ValueError, IndexError):
+            raise KeyError(key)
+        value = self._decoded[key] = envelope_field(value)
+        return value
+
+    def keys(self):
+        return ENVELOPE_FIELDS[:len(self._raw)]
+
+
+def _parse_envelope(envelope):
+    return Envelope(envelope)
+
+
+class BodyStructure(UserDict.DictMixin):
+    """A node of a BODYSTRUCTURE, decoded when first accessed.
+
+    Sub-parts are decoded only when they are accessed themselves:
+
+    >>> structure = BodyStructure(parse(
+    ...     '("TEXT" "PLAIN" ("CHARSET" "us-ascii") NIL NIL "7BIT" 12 1 NIL) '
+    ...     '("TEXT" "HTML" NIL "<id>" NIL "BASE64" 40 2 NIL) '
+    ...     '"ALTERNATIVE" ("BOUNDARY" "xyz")'), '')
+    >>> structure._data is None
+    True
+    >>> structure['content_type']
+    'multipart/alternative'
+    >>> text, html = structure['parts']
+    >>> html._data is None
+    True
+    >>> html['id'], html['encoding'], html['partnumber']
+    ('<id>', 'base64', '2')
+
+    """
+
+    _data = None
+
+    def __init__(self, structure, path):
+        self._structure = structure
+        self._path = path
+
+    def _decode(self):
+        structure, path = self._structure, self._path
+        if structure[:2] == ['message', 'rfc822']:
+            self._data = _parse_message_rfc822(structure, path)
+        elif isinstance(structure[0], str):
+            self._data = _parse_nonmultipart(structure, path)
+        else:
+            self._data = _parse_multipart(structure, path)
+        self._structure = None
+
+    def __getitem__(self, key):
+        if self._data is None:
+            self._decode()
+        return self._data[key]
+
+    def keys(self):
+        if self._data is None:
+            self._decode()
+        return self._data.keys()
 
 
 def _parse_structure(structure, path):
-    if structure[:2] == ['message', 'rfc822']:
-        return _parse_message_rfc822(structure, path)
-    elif isinstance(structure[0], str):
-        return _parse_nonmultipart(structure, path)
-    else:
-        return _parse_multipart(structure, path)
+    return BodyStructure(structure, path)
 
 
 def _parse_multipart(element, path):
@@ -179,7 +416,22 @@ def _parse_message_rfc822(element, path):
     return data
 
 
-ATOM_CHARS = [chr(i) for i in xrange(32, 256) if chr(i) not in r'(){%*"\ ]']
+ATOM_CHARS = frozenset(
+    chr(i) for i in xrange(32, 256) if chr(i) not in r'(){%*"\ ]')
+
+# The tokenizer scans the response by index using these precompiled
+# expressions instead of looking at one character at a time. An atom stops at
+# an opening bracket since that starts the section of an attribute spec.
+ATOM = re.compile(r'[^\x00-\x1f(){%*"\\ \[\]]+')
+QUOTED = re.compile(r'"([^"\\]*(?:\\(?:["\\]|(?!["\\]))[^"\\]*)*)"')
+QUOTED_ESCAPE = re.compile(r'\\(["\\])')
+LITERAL_LENGTH = re.compile(r'{([^}]*)}')
+# The remainder of an attribute spec after the opening bracket.
+ATTRIBUTE_SPEC = re.compile(r'[^\]]*\](?:<[^>]*>)?')
+
+# Parsed attribute specs by their text, see `read_atom`.
+_attribute_specs = {}
+ATTRIBUTE_SPEC_CACHE_SIZE = 256
 
 
 class ParseError(Exception):
@@ -276,10 +528,31 @@ class Atom(object):
     >>> Atom('123')
     <IMAP atom 123>
 
+    Atoms that occur in nearly every response, such as NIL and the names of
+    message attributes, are interned so that only one instance of them ever
+    exists:
+
+    >>> Atom('NIL') is Atom('NIL') is NIL
+    True
+    >>> Atom('123') is Atom('123')
+    False
+
     """
 
-    def __init__(self, value):
-        self.value = value
+    __slots__ = ('value',)
+
+    _interned = {}
+
+    def __new__(cls, value):
+        try:
+            return cls._interned[value]
+        except KeyError:
+            atom = object.__new__(cls)
+            atom.value = value
+            return atom
+
+    def __reduce__(self):
+        return (type(self), (self.value,))
 
     def __eq__(self, other):
         """Test for equality of two atoms.
@@ -297,7 +570,8 @@ class Atom(object):
         True
 
         """
-        return type(self) is type(other) and self.value == other.value
+        return self is other or (
+            type(self) is type(other) and self.value == other.value)
 
     def __ne__(self, other):
         """Test for inequality of two atoms.
@@ -333,8 +607,19 @@ class Flag(Atom):
     >>> str(Flag('foo'))
     '\\\\foo'
 
+    System flags and mailbox attributes are interned:
+
+    >>> Flag('Seen') is Flag('Seen')
+    True
+    >>> Flag('Seen') == Atom('Seen')
+    False
+
     """
 
+    __slots__ = ()
+
+    _interned = {}
+
     def __repr__(self):
         return "<IMAP flag \\%s>" % self.value
 
@@ -342,16 +627,41 @@ class Flag(Atom):
         return '\\' + self.value
 
 
+INTERNED_ATOMS = [
+    'NIL', 'UID', 'FLAGS', 'ENVELOPE', 'BODYSTRUCTURE', 'BODY', 'RFC822',
+    'RFC822.SIZE', 'RFC822.HEADER', 'RFC822.TEXT', 'INTERNALDATE', 'MODSEQ',
+    'MESSAGES', 'RECENT', 'UIDNEXT', 'UIDVALIDITY', 'UNSEEN',
+    'HIGHESTMODSEQ', 'HEADER', 'TEXT', 'MIME', 'HEADER.FIELDS',
+    'HEADER.FIELDS.NOT']
+
+INTERNED_FLAGS = [
+    'Seen', 'Answered', 'Flagged', 'Deleted', 'Draft', 'Recent',
+    'Noinferiors', 'Noselect', 'Marked', 'Unmarked', 'HasChildren',
+    'HasNoChildren']
+
+for value in INTERNED_ATOMS:
+    Atom._interned[value] = Atom(value)
+for value in INTERNED_FLAGS:
+    Flag._interned[value] = Flag(value)
+del value
+
+
 class AttributeSpec(object):
     """A message attribute specifier: UID, BODY[HEADER.FIELDS (FROM)] etc.
     """
 
+    __slots__ = ('primary', 'msgtext', 'header_list', 'range')
+
     def __init__(self, primary, msgtext=None, header_list=None, range=None):
         self.primary = primary
         self.msgtext = msgtext
         self.header_list = header_list
         self.range = range
 
+    def __reduce__(self):
+        return (type(self),
+                (self.primary, self.msgtext, self.header_list, self.range))
+
     def __repr__(self):
         return '<AttributeSpec %s>' % self
 
@@ -378,17 +688,22 @@ def read_quoted(data):
     >>> read_quoted(_('"asdf\\\\" " "foo"'))
     'asdf" '
 
+    >>> read_quoted(_('"a\\\\sdf"'))
+    'a\\\\sdf'
+
+    >>> read_quoted(_('"asdf'))
+    Traceback (most recent call last):
+    ParseError: Unexpected end of quoted string in '"asdf' at index 0.
+
     """
-    assert data.next() == '"'
-    result = ''
-    for c in data:
-        if c == '"':
-            break
-        if c == '\\' and data.ahead in ('"', '\\'):
-            c = data.next()
-        result += c
-    else:
+    assert data.string[data.index:data.index + 1] == '"'
+    match = QUOTED.match(data.string, data.index)
+    if match is None:
         raise ParseError('Unexpected end of quoted string', data)
+    data.index = match.end()
+    result = match.group(1)
+    if '\\' in result:
+        result = QUOTED_ESCAPE.sub(r'\1', result)
     return result
 
 
@@ -404,21 +719,36 @@ def read_literal(data):
     >>> read_literal(_('{0}\r\n'))
     ''
 
+    >>> read_literal(_('{4}\r\nas'))
+    Traceback (most recent call last):
+    ParseError: Unexpected end of literal string in '{4}...as' at index 9.
+
+    >>> read_literal(_('{x}\r\nas'))
+    Traceback (most recent call last):
+    ParseError: Non-integer token for length of literal string in
+    '{x}...as' at index 5.
+
     """
-    assert data.next() == '{'
-    count = ''
-    for c in data:
-        if c == '}':
-            break
-        count += c
-    if not (data.ahead and data.next() == '\r' and
-            data.ahead and data.next() == '\n'):
+    string = data.string
+    assert string[data.index:data.index + 1] == '{'
+    match = LITERAL_LENGTH.match(string, data.index)
+    if match is None:
+        data.index = len(string)
+        raise ParseError('Syntax error in literal string', data)
+    start = match.end() + 2
+    if string[match.end():start] != '\r\n':
+        data.index = min(start, len(string))
         raise ParseError('Syntax error in literal string', data)
+    data.index = start
     try:
-        count = int(count)
+        count = int(match.group(1))
     except ValueError:
         raise ParseError(
             'Non-integer token for length of literal string', data)
+    literals = getattr(string, 'literals', None)
+    if literals and start in literals:
+        # The literal has been left out of the line, see `unsplit`.
+        return literals[start]
 
     result = data.read(count)
     if len(result) < count:
@@ -436,10 +766,12 @@ def read_list(data):
     [<IMAP atom foo>, 'bar', [<IMAP atom baz>]]
 
     """
-    assert data.next() == '('
-    result = list(parse_recursive(data))
-    if not data.ahead or data.next() != ')':
+    assert data.string[data.index:data.index + 1] == '('
+    data.index += 1
+    result = parse_recursive(data)
+    if data.string[data.index:data.index + 1] != ')':
         raise ParseError('Unexpected end of list', data)
+    data.index += 1
     return result
 
 
@@ -474,34 +806,48 @@ def read_atom(data):
     <AttributeSpec BODY[HEADER.FIELDS (FROM)]<0>>
 
     """
-    assert data.ahead in ATOM_CHARS
-    result = ''
-    while data.ahead in ATOM_CHARS:
-        c = data.next()
-        if c == '[':
-            break
-        else:
-            result += c
+    string = data.string
+    start = data.index
+    assert string[start:start + 1] in ATOM_CHARS
+    match = ATOM.match(string, start)
+    if match is None:
+        result = ''
     else:
+        result = match.group()
+        data.index = match.end()
+    if string[data.index:data.index + 1] != '[':
         return Atom(result)
-
-    if data.ahead == ']':
+    data.index += 1
+
+    # The same attribute specs occur in the response for every message, so
+    # look them up by their text before parsing them.
+    match = ATTRIBUTE_SPEC.match(string, data.index)
+    if match is not None:
+        spec = _attribute_specs.get(string[start:match.end()])
+        if spec is not None:
+            data.index = match.end()
+            return spec
+
+    if string[data.index:data.index + 1] == ']':
         msgtext = ''
     else:
         msgtext = read_atom(data)
-    if data.ahead == ' ':
-        data.next()
+    if string[data.index:data.index + 1] == ' ':
+        data.index += 1
         header_list = read_list(data)
     else:
         header_list = None
-    if data.ahead != ']':
+    if string[data.index:data.index + 1] != ']':
         raise ParseError('Unexpected end of header list', data)
-    data.next()
-    if data.ahead == '<':
+    data.index += 1
+    if string[data.index:data.index + 1] == '<':
         range = read_atom(data)
     else:
         range = None
-    return AttributeSpec(result, msgtext, header_list, range)
+    spec = AttributeSpec(result, msgtext, header_list, range)
+    if len(_attribute_specs) < ATTRIBUTE_SPEC_CACHE_SIZE:
+        _attribute_specs[string[start:data.index]] = spec
+    return spec
 
 
 def read_flag(data):
@@ -511,8 +857,15 @@ def read_flag(data):
     <IMAP flag \\Flag>
 
     """
-    assert data.next() == '\\'
-    return Flag(read_atom(data).value)
+    string = data.string
+    assert string[data.index:data.index + 1] == '\\'
+    data.index += 1
+    assert string[data.index:data.index + 1] in ATOM_CHARS
+    match = ATOM.match(string, data.index)
+    if match is None:
+        return Flag('')
+    data.index = match.end()
+    return Flag(match.group())
 
 
 def parse_recursive(data):
@@ -522,29 +875,35 @@ def parse_recursive(data):
     operate on expressions that include all delimiting characters such as
     quotes, braces and parentheses, and always consume them entirely.
 
+    Returns the list of items read.
+
     """
+    string = data.string
+    result = []
+    append = result.append
     while True:
-        c = data.ahead
+        c = string[data.index:data.index + 1]
         if c == '"':
-            yield read_quoted(data)
+            append(read_quoted(data))
         elif c == '{':
-            yield read_literal(data)
+            append(read_literal(data))
         elif c == '(':
-            yield read_list(data)
+            append(read_list(data))
         elif c == '\\':
-            yield read_flag(data)
+            append(read_flag(data))
         elif c in ATOM_CHARS:
-            yield read_atom(data)
+            append(read_atom(data))
 
-        c = data.ahead
+        c = string[data.index:data.index + 1]
         if c == ' ':
-            data.next()
-        elif c in (')', None):
+            data.index += 1
+        elif c == ')' or not c:
             break
         elif c == '(':
             continue
         else:
             raise ParseError('Syntax error %s' % c, data)
+    return result
 
 
 def parse(data):
@@ -575,9 +934,13 @@ def parse(data):
     >>> parse(r'(BODYSTRUCTURE ("TEXT" "PLAIN") ("TEXT" "HTML"))')
     [[<IMAP atom BODYSTRUCTURE>, ['TEXT', 'PLAIN'], ['TEXT', 'HTML']]]
 
+    >>> parse('(foo))')
+    Traceback (most recent call last):
+    ParseError: Inconsistent nesting of lists in '(foo))' at index 5.
+
     """
     data = LookAheadStringIter(data)
-    result = list(parse_recursive(data))
+    result = parse_recursive(data)
     if data.ahead:
         raise ParseError('Inconsistent nesting of lists', data)
     return result
@@ -689,4 +1052,36 @@ def number(value):
         raise ValueError('%r cannot be read as a number.' % value)
 
 
+def envelope_field(value):
+    """Interpret a parsed value as a field of an ENVELOPE.
+
+    Address lists are formatted as in a message header, NIL becomes an empty
+    string:
+
+    >>> envelope_field('Subject')
+    'Subject'
+
+    >>> envelope_field(Atom('NIL'))
+    u''
+
+    >>> envelope_field([['Fred', NIL, 'fred', 'example.com'],
+    ...                 [NIL, NIL, 'joe', 'example.com']])
+    'Fred <fred@example.com>, joe@example.com'
+
+    """
+    if value is NIL:
+        return u''
+    elif isinstance(value, list):
+        # XXX handle RfC2822-style address groups
+        addresses = []
+        for item in value:
+            name, path, mailbox, host = item
+            if name is NIL:
+                addresses.append('%s@%s' % (mailbox, host))
+            else:
+                addresses.append('%s <%s@%s>' % (name, mailbox, host))
+        return ', '.join(addresses)
+    return value
+
+
 NIL = Atom('NIL')
@@ -0,0 +1,208 @@
+# Copyright (c) 2011 gocept gmbh & co. kg
+# See also LICENSE.txt
+"""Find out what changed in a folder since a client last looked at it."""
+
+import gocept.imapapi.parser
+
+
+class SyncState(object):
+    """What a client knows about a folder, to be kept between requests.
+
+    `modseq` is the folder's HIGHESTMODSEQ (RfC 7162) when the client last
+    looked, or None if the server doesn't support CONDSTORE. `uidnext` tells
+    which messages are new. `uids` are the UIDs of the messages known to the
+    client; they are only kept if the server doesn't support QRESYNC, which
+    reports removed messages by itself.
+
+    States are converted to plain data for persisting them:
+
+    >>> state = SyncState(1234, 17, 9, [1, 2, 3, 5, 7, 8])
+    >>> data = state.as_dict()
+    >>> sorted(data.items())
+    [('modseq', 17), ('uidnext', 9), ('uids', '1:3,5,7:8'), ('uidvalidity', 1234)]
+    >>> SyncState.from_dict(data)
+    <SyncState UIDVALIDITY 1234 MODSEQ 17 UIDNEXT 9, 6 UIDs>
+    >>> SyncState.from_dict(SyncState(1234, 17, 9).as_dict())
+    <SyncState UIDVALIDITY 1234 MODSEQ 17 UIDNEXT 9>
+
+    """
+
+    def __init__(self, uidvalidity, modseq, uidnext, uids=None):
+        self.uidvalidity = uidvalidity
+        self.modseq = modseq
+        self.uidnext = uidnext
+        if uids is not None:
+            uids = sorted(uids)
+        self.uids = uids
+
+    def __repr__(self):
+        result = '<SyncState UIDVALIDITY %s MODSEQ %s UIDNEXT %s' % (
+            self.uidvalidity, self.modseq, self.uidnext)
+        if self.uids is not None:
+            result += ', %s UIDs' % len(self.uids)
+        return result + '>'
+
+    def as_dict(self):
+        data = dict(uidvalidity=self.uidvalidity, modseq=self.modseq,
+                    uidnext=self.uidnext)
+        if self.uids is not None:
+            data['uids'] = sequence_set(self.uids)
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        uids = data.get('uids')
+        if uids is not None:
+            uids = uids and gocept.imapapi.parser.sequence_set(uids) or []
+        return cls(data['uidvalidity'], data['modseq'], data['uidnext'], uids)
+
+
+class Changes(object):
+    """The changes of a folder since a known state.
+
+    `new` and `vanished` are sorted lists of the UIDs of messages added and
+    removed. `flags` maps the UIDs of new messages and of messages whose
+    flags changed to their flags. `state` is the state to pass the next
+    time. If `reset` is true, what the client knew doesn't apply anymore,
+    e.g. since the folder's UIDVALIDITY changed, and all messages are
+    reported as new.
+
+    """
+
+    def __init__(self, state, new, vanished, flags, reset=False):
+        self.state = state
+        self.new = new
+        self.vanished = vanished
+        self.flags = flags
+        self.reset = reset
+
+    def __repr__(self):
+        return '<Changes: %s new, %s vanished, %s with flags>' % (
+            len(self.new), len(self.vanished), len(self.flags))
+
+
+def sequence_set(uids):
+    """Write ascending UIDs as a compact sequence set.
+
+    >>> sequence_set([1, 2, 3, 5, 7, 8])
+    '1:3,5,7:8'
+    >>> sequence_set([])
+    ''
+
+    """
+    ranges = []
+    for uid in uids:
+        if ranges and ranges[-1][1] == uid - 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join(first == last and str(first) or '%s:%s' % (first, last)
+                    for first, last in ranges)
+
+
+def changes_since(folder, state=None):
+    """Return the changes of a folder since a state, or all its messages.
+
+    The folder is selected again, which tells its current UIDVALIDITY,
+    UIDNEXT and HIGHESTMODSEQ. With CONDSTORE (RfC 7162), only messages
+    changed since the state's MODSEQ are fetched; QRESYNC also reports the
+    UIDs of messages removed meanwhile, otherwise the UIDs of all messages
+    are searched to find out, as they are if the connection couldn't enable
+    QRESYNC. All commands are pipelined, so refreshing a folder costs a
+    single round trip and work proportional to what changed.
+    Without CONDSTORE, the flags of all messages are fetched and reported.
+
+    """
+    server = folder.server
+    strategy = server.capabilities.resync
+    if strategy == 'QRESYNC' and 'QRESYNC' not in server.enabled:
+        # QRESYNC is enabled when logging in (see Account.connect); CONDSTORE
+        # is used by itself without being enabled.
+        strategy = 'CONDSTORE'
+    incremental = (
+        state is not None and state.modseq is not None and
+        strategy is not None and
+        (strategy == 'QRESYNC' or state.uids is not None))
+    listing = incremental and strategy == 'CONDSTORE'
+
+    pipeline = server.pipeline()
+    pipeline.select(folder.encoded_path, callback=folder._selected)
+    if incremental:
+        modifiers = 'CHANGEDSINCE %s' % state.modseq
+        if strategy == 'QRESYNC':
+            modifiers += ' VANISHED'
+        pipeline.uid('FETCH', '1:*', '(UID FLAGS)', '(%s)' % modifiers)
+    else:
+        pipeline.uid('FETCH', '1:*', '(UID FLAGS)')
+    if listing:
+        if server.capabilities.search == 'ESEARCH':
+            pipeline.uid('SEARCH', 'RETURN', '(ALL)', 'ALL')
+        else:
+            pipeline.uid('SEARCH', 'ALL')
+    results = pipeline.execute()
+
+    code, data = results[0]
+    assert code == 'OK', '%s %r' % (code, data)
+    responses = server.untagged_responses
+    uidvalidity = int(responses['UIDVALIDITY'][-1])
+    uidnext = int(responses.get('UIDNEXT', [0])[-1])
+    modseq = responses.get('HIGHESTMODSEQ')
+    if modseq:
+        modseq = int(modseq[-1])
+    else:
+        # The folder doesn't keep modification sequences.
+        modseq = None
+    vanished = gocept.imapapi.parser.vanished(responses.pop('VANISHED', []))
+
+    reset = state is not None and (
+        state.uidvalidity != uidvalidity or
+        (not incremental and state.uids is None))
+    code, data = results[1]
+    if incremental and (reset or code != 'OK'):
+        # Changes since a MODSEQ of another UIDVALIDITY don't mean anything.
+        incremental = False
+        pipeline = server.pipeline()
+        pipeline.uid('FETCH', '1:*', '(UID FLAGS)')
+        code, data = pipeline.execute()[0]
+    assert code == 'OK', '%s %r' % (code, data)
+    flags = dict((item['UID'], item['FLAGS']) for item in _fetched(data))
+
+    if incremental and strategy == 'QRESYNC':
+        new = [uid for uid in flags if uid >= state.uidnext]
+        vanished = [uid for uid in vanished if uid < state.uidnext]
+        uids = None
+    else:
+        if listing:
+            code, data = results[2]
+            assert code == 'OK', '%s %r' % (code, data)
+            current = set(_searched(server, data))
+        else:
+            current = set(flags)
+        known = set()
+        if state is not None and not reset:
+            known = set(state.uids)
+        new = current - known
+        vanished = known - current
+        flags = dict((uid, value) for uid, value in flags.items()
+                     if uid in current)
+        uids = None
+        if strategy != 'QRESYNC':
+            uids = current
+
+    uidnext = max([uidnext] + [uid + 1 for uid in flags])
+    return Changes(SyncState(uidvalidity, modseq, uidnext, uids),
+                   sorted(new), sorted(vanished), flags, reset)
+
+
+def _fetched(data):
+    if data == [None]:
+        return []
+    return gocept.imapapi.parser.fetch(data, fetch_all=True)
+
+
+def _searched(server, data):
+    if data == [None]:
+        return []
+    if server.capabilities.search == 'ESEARCH':
+        return gocept.imapapi.parser.esearch(data).get('ALL', [])
+    return gocept.imapapi.parser.search(data)
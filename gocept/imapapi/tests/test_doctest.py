@@ -30,7 +30,25 @@ def test_suite():
     suite.addTest(doctest.DocTestSuite(
         'gocept.imapapi.parser',
         optionflags=optionflags))
+    suite.addTest(doctest.DocTestSuite(
+        'gocept.imapapi.message',
+        optionflags=optionflags))
     suite.addTest(doctest.DocTestSuite(
         'gocept.imapapi.folder',
         optionflags=optionflags))
+    suite.addTest(doctest.DocTestSuite(
+        'gocept.imapapi.benchmark',
+        optionflags=optionflags))
+    suite.addTest(doctest.DocTestSuite(
+        'gocept.imapapi.imap',
+        optionflags=optionflags))
+    suite.addTest(doctest.DocTestSuite(
+        'gocept.imapapi.instrumentation',
+        optionflags=optionflags))
+    suite.addTest(doctest.DocTestSuite(
+        'gocept.imapapi.resync',
+        optionflags=optionflags))
+    suite.addTest(doctest.DocTestSuite(
+        'gocept.imapapi.migrate',
+        optionflags=optionflags))
     return suite
@@ -0,0 +1,187 @@
+# Copyright (c) 2011 gocept gmbh & co. kg
+# See also LICENSE.txt
+
+import gocept.imapapi.account
+import gocept.imapapi.folder
+import gocept.imapapi.imap
+import unittest
+
+
+LIST = ['(\\HasChildren) "/" "INBOX"',
+        '(\\HasNoChildren) "/" "INBOX/Drafts"',
+        '(\\Noselect \\HasChildren) "/" "Archive"',
+        '(\\HasNoChildren) "/" "Archive/2010"']
+
+STATUS = {
+    'INBOX': 'INBOX (MESSAGES 3 UNSEEN 1 UIDNEXT 4 UIDVALIDITY 7)',
+    'INBOX/Drafts': 'INBOX/Drafts (MESSAGES 0 UNSEEN 0 UIDNEXT 1 '
+                    'UIDVALIDITY 8)',
+    'Archive/2010': 'Archive/2010 (MESSAGES 12 UNSEEN 0 UIDNEXT 13 '
+                    'UIDVALIDITY 9)',
+    }
+
+
+class Pipeline(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.commands = []
+        self.callbacks = {}
+
+    def status(self, path, names, callback=None):
+        self.commands.append((path, names))
+        self.callbacks[path] = callback
+
+    def execute(self):
+        self.send()
+        return self.complete()
+
+    def send(self):
+        self.connection.sent.extend(
+            ('STATUS', path, names) for path, names in self.commands)
+
+    def complete(self):
+        results = [(path, ('OK', [STATUS[path]]))
+                   for path, names in self.commands]
+        for path, (code, data) in results:
+            if self.callbacks.get(path) is not None:
+                self.callbacks[path](code, data)
+        return [result for path, result in results]
+
+
+class Connection(object):
+    """Answers the commands used for listing folders and their status."""
+
+    selected_path = None
+
+    def __init__(self, capabilities):
+        self.capabilities = gocept.imapapi.imap.Capabilities()
+        self.capabilities.update(capabilities)
+        self.sent = []
+
+    def list(self, directory, pattern):
+        self.sent.append(('LIST', directory, pattern))
+        return 'OK', list(LIST)
+
+    def list_status(self, pattern, items):
+        self.sent.append(('LIST-STATUS', pattern, tuple(items)))
+        return 'OK', list(LIST), [
+            STATUS[path] for path in sorted(STATUS)]
+
+    def pipeline(self):
+        return Pipeline(self)
+
+
+class Account(object):
+    """Just what the folder tree and folder counts need of an account."""
+
+    def __init__(self, capabilities):
+        self.server = Connection(capabilities)
+        self.folder_names = gocept.imapapi.folder.NameCache()
+        self.folder_tree = gocept.imapapi.folder.FolderTree(self)
+        self.folder_status = gocept.imapapi.folder.StatusCache(60)
+
+
+class Pool(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.paths = []
+
+    def get(self, path=None):
+        self.paths.append(path)
+        return self.connection
+
+
+class ServerlessAccount(gocept.imapapi.account.Account):
+    """An account talking to a stub connection instead of logging in."""
+
+    def __init__(self, capabilities):
+        self.pool = Pool(Connection(capabilities))
+        self.folder_names = gocept.imapapi.folder.NameCache()
+        self.folder_tree = gocept.imapapi.folder.FolderTree(self)
+        self.folder_status = gocept.imapapi.folder.StatusCache(60)
+        self.watchers = {}
+
+
+class FolderTreeStatusTest(unittest.TestCase):
+
+    def assertStatus(self, status):
+        self.assertEqual(['Archive/2010', 'INBOX', 'INBOX/Drafts'],
+                         sorted(status))
+        self.assertEqual(dict(MESSAGES=3, UNSEEN=1, UIDNEXT=4,
+                              UIDVALIDITY=7), status['INBOX'])
+
+    def test_list_status_asks_for_all_items_by_default(self):
+        account = Account(['IMAP4rev1', 'LIST-STATUS'])
+        self.assertStatus(account.folder_tree.status())
+        self.assertEqual(
+            [('LIST-STATUS', '*', gocept.imapapi.folder.STATUS_ITEMS)],
+            account.server.sent)
+
+    def test_pipelined_status_asks_for_all_items_by_default(self):
+        account = Account(['IMAP4rev1'])
+        self.assertStatus(account.folder_tree.status())
+        items = '(%s)' % ' '.join(gocept.imapapi.folder.STATUS_ITEMS)
+        self.assertEqual(
+            [('LIST', '', '*'),
+             ('STATUS', 'Archive/2010', items),
+             ('STATUS', 'INBOX', items),
+             ('STATUS', 'INBOX/Drafts', items)],
+            account.server.sent)
+
+
+class FolderCountsTest(unittest.TestCase):
+
+    def assertCounts(self, account):
+        folders = account.folder_counts()
+        self.assertEqual([u'Archive', u'Archive/2010', u'INBOX',
+                          u'INBOX/Drafts'], sorted(folders))
+        sent = len(account.server.sent)
+        inbox = folders[u'INBOX']
+        self.assertEqual((3, 1, 4, 7), (
+            inbox.message_count, inbox.unread_message_count,
+            inbox.uidnext, inbox.uidvalidity))
+        self.assertEqual(12, folders[u'Archive/2010'].message_count)
+        # The counts are taken from the account's status cache.
+        self.assertEqual(sent, len(account.server.sent))
+
+    def test_list_status(self):
+        self.assertCounts(ServerlessAccount(['IMAP4rev1', 'LIST-STATUS']))
+
+    def test_pipelined_status(self):
+        self.assertCounts(ServerlessAccount(['IMAP4rev1']))
+
+
+class FolderStatusTest(unittest.TestCase):
+
+    def test_one_connection_per_account(self):
+        first = ServerlessAccount(['IMAP4rev1'])
+        second = ServerlessAccount(['IMAP4rev1'])
+        folders = [first.folders[u'INBOX'],
+                   first.folders[u'INBOX'].folders[u'Drafts'],
+                   second.folders[u'Archive'].folders[u'2010']]
+        del first.pool.paths[:], second.pool.paths[:]
+        statuses = gocept.imapapi.folder.folder_status(
+            folders, ['MESSAGES', 'UNSEEN'])
+        self.assertEqual([(3, 1), (0, 0), (12, 0)],
+                         [(status['MESSAGES'], status['UNSEEN'])
+                          for status in statuses])
+        self.assertEqual([None], first.pool.paths)
+        self.assertEqual([None], second.pool.paths)
+        self.assertEqual(
+            [('STATUS', 'INBOX', '(MESSAGES UNSEEN)'),
+             ('STATUS', 'INBOX/Drafts', '(MESSAGES UNSEEN)')],
+            [command for command in first.server.sent
+             if command[0] == 'STATUS'])
+        # The values are cached by each account.
+        self.assertEqual(12, folders[2].message_count)
+        self.assertEqual([None], second.pool.paths)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(FolderTreeStatusTest))
+    suite.addTest(unittest.makeSuite(FolderCountsTest))
+    suite.addTest(unittest.makeSuite(FolderStatusTest))
+    return suite
@@ -0,0 +1,55 @@
+# Copyright (c) 2011 gocept gmbh & co. kg
+# See also LICENSE.txt
+
+import gocept.imapapi.folder
+import random
+import unittest
+
+
+class ModifiedUTF7Test(unittest.TestCase):
+
+    def random_text(self, random):
+        chars = []
+        for i in xrange(random.randint(0, 20)):
+            kind = random.randint(0, 3)
+            if kind == 0:
+                chars.append(random.choice(u'&-+/,'))
+            elif kind == 1:
+                chars.append(unichr(random.randint(0x00, 0x7f)))
+            elif kind == 2:
+                chars.append(unichr(random.randint(0x80, 0xd7ff)))
+            else:
+                chars.append(unichr(random.randint(0xe000, 0xffff)))
+        return u''.join(chars)
+
+    def test_round_trip(self):
+        encode = gocept.imapapi.folder.encode_modified_utf7
+        decode = gocept.imapapi.folder.decode_modified_utf7
+        rnd = random.Random(3501)
+        for i in xrange(5000):
+            text = self.random_text(rnd)
+            encoded = encode(text)
+            self.assertTrue(all('\x20' <= c <= '\x7e' for c in encoded),
+                            repr(encoded))
+            self.assertEqual(text, decode(encoded))
+
+    def test_decode_junk(self):
+        decode = gocept.imapapi.folder.decode_modified_utf7
+        rnd = random.Random(3501)
+        for i in xrange(5000):
+            bytes = ''.join(chr(rnd.choice([38, 45, rnd.randint(0, 255)]))
+                            for j in xrange(rnd.randint(0, 20)))
+            self.assertTrue(isinstance(decode(bytes), unicode))
+
+    def test_name_cache_round_trip(self):
+        names = gocept.imapapi.folder.NameCache(size=10)
+        rnd = random.Random(3501)
+        for i in xrange(500):
+            text = self.random_text(rnd)
+            self.assertEqual(text, names.decode(names.encode(text)))
+        self.assertEqual(10, len(names.encoded))
+        self.assertEqual(10, len(names.decoded))
+
+
+def test_suite():
+    return unittest.makeSuite(ModifiedUTF7Test)